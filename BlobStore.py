@@ -0,0 +1,273 @@
+# Copyright (C) 2009, Justin Lewis  (jtl1728@rit.edu)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import zlib
+import base64
+import tempfile
+import threading
+import simplejson
+from hashlib import sha1
+
+import ContentHash
+import journalentrybundle
+
+import logging
+_logger = logging.getLogger('fileshare-activity.BlobStore')
+
+class BlobStore(object):
+    """
+    Content addressed store for payloads.
+
+    Each payload is kept once as blob_dir/<sha1> and every user of it holds
+    a hard link to the blob, so its link count is its reference count.  A
+    blob is removed when the last link to it is released, blobs nothing
+    links to any more are removed by collect().
+    """
+    def __init__(self, blob_dir):
+        self._blob_dir = blob_dir
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(self._blob_dir):
+            os.makedirs(self._blob_dir)
+
+    def _blob_path(self, digest):
+        return os.path.join(self._blob_dir, digest)
+
+    def temp_path(self):
+        """Returns a new empty file next to the blobs, to be added with move"""
+        fd, path = tempfile.mkstemp(dir=self._blob_dir, prefix='tmp')
+        os.close(fd)
+        return path
+
+    def _read(self, src, dst=None):
+        """Reads src once, copying it to dst, returns (sha1, crc, size)"""
+        digest = sha1()
+        crc = 0
+        size = 0
+
+        src_fd = open(src, 'rb')
+        try:
+            dst_fd = dst and open(dst, 'wb')
+            try:
+                while True:
+                    data = src_fd.read(ContentHash.CHUNK_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    crc = zlib.crc32(data, crc)
+                    size += len(data)
+                    if dst_fd:
+                        dst_fd.write(data)
+            finally:
+                if dst_fd:
+                    dst_fd.close()
+        finally:
+            src_fd.close()
+        return digest.hexdigest(), crc & 0xffffffff, size
+
+    def add(self, src, dst, move=False):
+        """
+        Stores the file at src and links dst to its blob.  With move src
+        must be in the store's directory and is taken over.  Returns the
+        (sha1, crc, size) of the payload.
+        """
+        if move:
+            tmp_path = src
+            payload = self._read(src)
+        else:
+            tmp_path = self.temp_path()
+            try:
+                payload = self._read(src, tmp_path)
+            except:
+                os.remove(tmp_path)
+                raise
+
+        blob_path = self._blob_path(payload[0])
+        self._lock.acquire()
+        try:
+            if os.path.exists(blob_path):
+                _logger.debug("Payload %s already stored", payload[0])
+                os.remove(tmp_path)
+            else:
+                os.rename(tmp_path, blob_path)
+            ContentHash.link_or_copy(blob_path, dst)
+        finally:
+            self._lock.release()
+        return payload
+
+    def link(self, digest, dst, src):
+        """Links dst to a stored blob, restoring the blob from src if gone"""
+        blob_path = self._blob_path(digest)
+        self._lock.acquire()
+        try:
+            if not os.path.exists(blob_path):
+                ContentHash.link_or_copy(src, blob_path)
+            ContentHash.link_or_copy(blob_path, dst)
+        finally:
+            self._lock.release()
+
+    def release(self, path, digest):
+        """Removes the link at path and the blob if nothing else uses it"""
+        self._lock.acquire()
+        try:
+            os.remove(path)
+            self._collect(self._blob_path(digest))
+        finally:
+            self._lock.release()
+
+    def _collect(self, blob_path):
+        try:
+            if os.stat(blob_path).st_nlink == 1:
+                os.remove(blob_path)
+                return True
+        except OSError:
+            pass
+        return False
+
+    def collect(self):
+        """Removes every blob nothing links to, returns how many"""
+        removed = 0
+        self._lock.acquire()
+        try:
+            for name in os.listdir(self._blob_dir):
+                if self._collect(os.path.join(self._blob_dir, name)):
+                    removed += 1
+        finally:
+            self._lock.release()
+        if removed:
+            _logger.debug("Removed %d unused blobs", removed)
+        return removed
+
+class ShareStore(object):
+    """
+    Entries shared under an id.  Each is a record in share_dir of what its
+    bundle holds besides the payload, and a link to the payload's blob.
+    Bundles are assembled from the two as StoredBundles when needed, so an
+    entry takes the disk space of its payload once however often and
+    under whatever ids it is shared.
+    """
+    def __init__(self, share_dir, blobs):
+        self._share_dir = share_dir
+        self._blobs = blobs
+
+    def _record_path(self, file_id):
+        return os.path.join(self._share_dir, '%s.json' % file_id)
+
+    def _payload_path(self, file_id):
+        return os.path.join(self._share_dir, '%s.data' % file_id)
+
+    def has(self, file_id):
+        return os.path.exists(self._record_path(file_id))
+
+    def ids(self):
+        return [name[:-len('.json')] for name in os.listdir(self._share_dir)
+                if name.endswith('.json')]
+
+    def add(self, file_id, entry_id, metadata, preview=None, payload_path=None,
+            payload=None, move=False):
+        """
+        Shares an entry as file_id and returns its bundle.  metadata is
+        the encoded _metadata.json.  The payload at payload_path is stored,
+        unless payload gives the (sha1, crc, size) of a blob it is already
+        a link to.
+        """
+        record = {'entry_id': entry_id,
+                  'metadata': metadata,
+                  'preview': None,
+                  'payload': None}
+        if preview is not None:
+            record['preview'] = base64.b64encode(preview)
+
+        if payload_path:
+            if payload:
+                self._blobs.link(payload[0], self._payload_path(file_id), payload_path)
+            else:
+                payload = self._blobs.add(payload_path, self._payload_path(file_id), move)
+            record['payload'] = list(payload)
+
+        try:
+            self._write(file_id, record)
+        except:
+            if payload_path:
+                self._blobs.release(self._payload_path(file_id), payload[0])
+            raise
+        return self.get(file_id)
+
+    def add_bundle(self, file_id, bundle_path):
+        """Shares the entry in the bundle at bundle_path, which is removed"""
+        bundle = journalentrybundle.JournalEntryBundle(bundle_path)
+        tmp_path = self._blobs.temp_path()
+        try:
+            try:
+                entry_id, metadata, preview = bundle.read_entry()
+                has_payload = bundle.extract_file(tmp_path)
+            finally:
+                bundle.close()
+
+            if has_payload:
+                shared = self.add(file_id, entry_id, metadata, preview, tmp_path, move=True)
+            else:
+                shared = self.add(file_id, entry_id, metadata, preview)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        os.remove(bundle_path)
+        return shared
+
+    def _write(self, file_id, record):
+        tmp_path = self._record_path(file_id) + '.tmp'
+        fd = open(tmp_path, 'wb')
+        try:
+            fd.write(simplejson.dumps(record))
+        finally:
+            fd.close()
+        os.rename(tmp_path, self._record_path(file_id))
+
+    def _read(self, file_id):
+        path = self._record_path(file_id)
+        try:
+            return simplejson.loads(open(path, 'rb').read()), os.path.getmtime(path)
+        except EnvironmentError:
+            return None, None
+
+    def get(self, file_id):
+        """Returns the bundle of a shared entry or None"""
+        record, mtime = self._read(file_id)
+        if record is None:
+            return None
+
+        preview = record['preview']
+        if preview is not None:
+            preview = base64.b64decode(preview)
+
+        payload = None
+        if record['payload']:
+            digest, crc, size = record['payload']
+            payload = (self._payload_path(file_id), size, crc, str(digest))
+
+        return journalentrybundle.StoredBundle('%s.xoj' % file_id,
+                str(record['entry_id']), record['metadata'].encode('utf-8'), preview,
+                payload, mtime)
+
+    def remove(self, file_id):
+        """Stops sharing file_id, releasing its payload"""
+        record, mtime = self._read(file_id)
+        if record is None:
+            return
+        os.remove(self._record_path(file_id))
+        if record['payload']:
+            self._blobs.release(self._payload_path(file_id), str(record['payload'][0]))
@@ -0,0 +1,163 @@
+# Copyright (C) 2009, Justin Lewis  (jtl1728@rit.edu)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import uuid
+import simplejson
+
+import logging
+_logger = logging.getLogger('fileshare-activity.Catalog')
+
+# Number of changes remembered for building deltas
+LOG_SIZE = 1024
+
+class Catalog(object):
+    """
+    Versioned collection of shared files.
+
+    Every add or remove bumps the version and is logged, so a peer that
+    knows an older version can be sent only the changes it missed.  Once
+    the log no longer reaches back that far a full snapshot is needed.
+
+    Encoded entries and the encoded snapshot are cached until the entries
+    they were built from change, so serving many joiners costs one encode.
+    """
+    def __init__(self, log_size=LOG_SIZE):
+        self.catalog_id = uuid.uuid4().hex
+        self.version = 0
+        self._files = {}
+
+        # share_dump of each entry when last stored, updates that leave it
+        # alone (download progress) keep the cached encodings
+        self._dumps = {}
+
+        # Ids changed at versions _log_start + 1 up to version
+        self._log = []
+        self._log_start = 0
+        self._log_size = log_size
+
+        # Encoded entries by id, and whole catalog encodings
+        self._fragments = {}
+        self._snapshot = None
+        self._snapshot_records = None
+
+    # Read only dict access, add and remove go through the methods below
+    def has_key(self, key):
+        return self._files.has_key(key)
+
+    __contains__ = has_key
+
+    def __getitem__(self, key):
+        return self._files[key]
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __len__(self):
+        return len(self._files)
+
+    def keys(self):
+        return self._files.keys()
+
+    def add(self, key, file_obj):
+        self._files[key] = file_obj
+        self._dumps[key] = file_obj.share_dump()
+        self._changed(key)
+
+    def remove(self, key):
+        del self._files[key]
+        del self._dumps[key]
+        self._changed(key)
+
+    def update(self, key, file_obj):
+        """Replaces the local copy of an entry without bumping the version"""
+        if self._files.has_key(key):
+            self._files[key] = file_obj
+            dump = file_obj.share_dump()
+            if dump != self._dumps[key]:
+                self._dumps[key] = dump
+                self._invalidate(key)
+
+    def _invalidate(self, key):
+        if self._fragments.has_key(key):
+            del self._fragments[key]
+        self._snapshot = None
+        self._snapshot_records = None
+
+    def _changed(self, key):
+        self._invalidate(key)
+        self.version += 1
+        self._log.append(key)
+
+        if len(self._log) > self._log_size:
+            drop = len(self._log) - self._log_size
+            del self._log[:drop]
+            self._log_start += drop
+
+    def sync_to(self, catalog_id, version):
+        """Marks this copy as a mirror of a remote catalog at version"""
+        self.catalog_id = catalog_id
+        self.version = version
+        self._log = []
+        self._log_start = version
+
+    def delta_since(self, version):
+        """
+        Returns (added, removed) lists of ids changed after version, or None
+        if the log does not reach back to it.
+        """
+        if version < self._log_start or version > self.version:
+            return None
+
+        added = []
+        removed = []
+        seen = set()
+        for key in self._log[version - self._log_start:]:
+            if key in seen:
+                continue
+            seen.add(key)
+            if self._files.has_key(key):
+                added.append(key)
+            else:
+                removed.append(key)
+        return added, removed
+
+    def records(self, keys):
+        """Returns the share_dump of each key as a tuple for D-Bus structs"""
+        return [tuple(self._files[key].share_dump()) for key in keys]
+
+    def snapshot_records(self):
+        if self._snapshot_records is None:
+            self._snapshot_records = self.records(self._files)
+        return self._snapshot_records
+
+    def encode_entry(self, key):
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            fragment = simplejson.dumps(self._files[key].share_dump())
+            self._fragments[key] = fragment
+        return fragment
+
+    def encode_delta(self, added, removed):
+        return '{"add": [%s], "rem": %s}' % (
+                ', '.join([self.encode_entry(key) for key in added]),
+                simplejson.dumps(removed))
+
+    def encode_snapshot(self):
+        if self._snapshot is None:
+            self._snapshot = '{%s}' % ', '.join(['%s: %s' % (simplejson.dumps(key),
+                                                             self.encode_entry(key))
+                                                 for key in self._files])
+        return self._snapshot
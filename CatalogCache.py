@@ -0,0 +1,130 @@
+# Copyright (C) 2009, Justin Lewis  (jtl1728@rit.edu)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import simplejson
+from hashlib import sha1
+
+import logging
+_logger = logging.getLogger('fileshare-activity.CatalogCache')
+
+# Entries asked for per page of the server file list
+PAGE_SIZE = 500
+
+# Times paging starts over when the list changes while being fetched
+MAX_RESTARTS = 3
+
+class CatalogCache(object):
+    """
+    Last file list seen from each source, kept on disk together with the
+    ETag it was served with so it can be revalidated instead of refetched.
+    """
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        if not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir)
+
+    def _path(self, key):
+        return os.path.join(self._cache_dir, '%s.json' % sha1(key).hexdigest())
+
+    def load(self, key):
+        """Returns (etag, filelist) last saved for key or (None, None)"""
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None, None
+        try:
+            data = simplejson.loads(open(path, 'rb').read())
+            return data['etag'], data['files']
+        except Exception, e:
+            _logger.warn("Could not read cached catalog %s: %s", path, e)
+            return None, None
+
+    def save(self, key, etag, filelist):
+        self.save_encoded(key, etag, simplejson.dumps(filelist))
+
+    def save_encoded(self, key, etag, filelist_json):
+        """Same as save but with the file list already encoded as JSON"""
+        path = self._path(key)
+        tmp_path = path + '.tmp'
+        fd = open(tmp_path, 'wb')
+        try:
+            fd.write('{"key": %s, "etag": %s, "files": %s}' % (simplejson.dumps(key),
+                     simplejson.dumps(etag), filelist_json))
+        finally:
+            fd.close()
+        os.rename(tmp_path, path)
+
+    def remove(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+def fetch_filelist(client, cache, key, page_cb, page_size=PAGE_SIZE):
+    """
+    Fetches the server file list a page at a time through client, handing
+    each decoded page to page_cb as it arrives.  The cached copy is sent
+    with If-None-Match and reused on 304.  Servers that don't page return
+    everything in the first response.  Returns (status, filelist), the
+    list is None unless status is 200 or 304.
+    """
+    etag, cached = cache.load(key)
+    restarts = 0
+
+    while True:
+        files = {}
+        offset = 0
+        list_etag = None
+        consistent = True
+        headers = {}
+        if etag and cached is not None:
+            headers['If-None-Match'] = etag
+
+        while True:
+            status, response_headers, data = client.get_with_headers(
+                    '/filelist?offset=%d&limit=%d' % (offset, page_size), headers)
+
+            if status == 304 and offset == 0:
+                _logger.debug("Server file list unchanged, using cached copy")
+                page_cb(cached)
+                return status, cached
+            if status != 200:
+                return status, None
+
+            page_etag = response_headers.get('etag')
+            if offset == 0:
+                list_etag = page_etag
+                headers = {}
+            elif page_etag != list_etag:
+                if restarts < MAX_RESTARTS:
+                    break
+                # Out of restarts, keep the pages but don't cache the mix
+                consistent = False
+
+            page = simplejson.loads(data)
+            files.update(page)
+            page_cb(page)
+
+            next_offset = response_headers.get('x-fileshare-next-offset')
+            if not next_offset:
+                if list_etag and consistent:
+                    cache.save(key, list_etag, files)
+                return status, files
+            offset = int(next_offset)
+
+        # List changed between pages, start over
+        restarts += 1
+        _logger.debug("Server file list changed while paging, restarting")
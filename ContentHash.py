@@ -0,0 +1,213 @@
+# Copyright (C) 2009, Justin Lewis  (jtl1728@rit.edu)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import time
+import shutil
+import threading
+import simplejson
+from hashlib import sha1
+
+import logging
+_logger = logging.getLogger('fileshare-activity.ContentHash')
+
+# Read size used while hashing, keeps memory use flat regardless of file size
+CHUNK_SIZE = 64 * 1024
+
+# Total size of the payloads kept by the hash index
+MAX_BYTES = 64 * 1024 * 1024
+
+# Format of the saved hash index, older ones are dropped
+INDEX_VERSION = 3
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    """Returns the sha1 hex digest of the file at path, read in chunks"""
+    digest = sha1()
+    total = 0
+    start = time.time()
+
+    fd = open(path, 'rb')
+    try:
+        while True:
+            data = fd.read(chunk_size)
+            if not data:
+                break
+            digest.update(data)
+            total += len(data)
+    finally:
+        fd.close()
+
+    elapsed = time.time() - start
+    if elapsed > 0:
+        rate = total / elapsed
+    else:
+        rate = float(total)
+    _logger.debug("Hashed %s: %d bytes in %.2fs (%.0f bytes/s)",
+                  path, total, elapsed, rate)
+
+    return digest.hexdigest()
+
+def link_or_copy(src, dst):
+    """Hard links src to dst, falling back to a copy across filesystems"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+class HashIndex(object):
+    """
+    Persistent index of objects that have already been packaged.
+
+    Entries are keyed by the datastore object id together with the size,
+    mtime and inode of its file, since the datastore hands out a new path
+    every time the file is asked for.  They map to the object hash, a link
+    to the payload named after the key and the payload's sha1, crc and
+    size.  The least recently used entries are evicted once the cached
+    payloads take up more than max_bytes.
+    """
+    def __init__(self, index_path, payload_dir, max_bytes=MAX_BYTES):
+        self._index_path = index_path
+        self._payload_dir = payload_dir
+        self._max_bytes = max_bytes
+        self._entries = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(self._payload_dir):
+            os.makedirs(self._payload_dir)
+
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self._index_path):
+            return
+        try:
+            data = simplejson.loads(open(self._index_path, 'rb').read())
+            entries = data['entries']
+            tick = data['tick']
+            version = data.get('version')
+        except Exception, e:
+            _logger.warn("Could not read hash index %s: %s", self._index_path, e)
+            return
+
+        if version != INDEX_VERSION:
+            # Older formats cached whole bundles, start over
+            for entry in entries.itervalues():
+                try:
+                    os.remove(entry.get('payload', entry.get('bundle')))
+                except (OSError, TypeError):
+                    pass
+            return
+
+        self._entries = entries
+        self._tick = tick
+
+    def save(self):
+        tmp_path = self._index_path + '.tmp'
+        fd = open(tmp_path, 'wb')
+        try:
+            fd.write(simplejson.dumps({'version': INDEX_VERSION,
+                                       'entries': self._entries,
+                                       'tick': self._tick}))
+        finally:
+            fd.close()
+        os.rename(tmp_path, self._index_path)
+
+    def _key(self, object_id, path):
+        st = os.stat(path)
+        return '%s:%d:%d:%d' % (object_id, st.st_size, int(st.st_mtime), st.st_ino)
+
+    def lookup(self, object_id, path, meta_hash):
+        """Returns the entry of an unchanged object or None"""
+        self._lock.acquire()
+        try:
+            return self._lookup(object_id, path, meta_hash)
+        finally:
+            self._lock.release()
+
+    def _lookup(self, object_id, path, meta_hash):
+        try:
+            key = self._key(object_id, path)
+        except OSError:
+            return None
+
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+
+        if entry['meta'] != meta_hash or not os.path.exists(entry['payload']):
+            # Metadata changed or cached payload is gone, must repackage
+            self._remove(key)
+            return None
+
+        self._tick += 1
+        entry['tick'] = self._tick
+        return dict(entry)
+
+    def store(self, object_id, path, meta_hash, object_hash, payload_path, payload):
+        """
+        Records a freshly packaged object and links its stored payload,
+        payload being its (sha1, crc, size)
+        """
+        self._lock.acquire()
+        try:
+            self._store(object_id, path, meta_hash, object_hash, payload_path, payload)
+        finally:
+            self._lock.release()
+
+    def _store(self, object_id, path, meta_hash, object_hash, payload_path, payload):
+        digest, crc, size = payload
+        try:
+            key = self._key(object_id, path)
+        except OSError:
+            return
+
+        if size > self._max_bytes:
+            # Would evict everything else and itself right away
+            return
+
+        if self._entries.has_key(key):
+            self._remove(key)
+
+        cached_path = os.path.join(self._payload_dir, sha1(key).hexdigest())
+        if os.path.exists(cached_path):
+            os.remove(cached_path)
+        link_or_copy(payload_path, cached_path)
+
+        self._tick += 1
+        self._entries[key] = {'hash': object_hash,
+                              'meta': meta_hash,
+                              'payload': cached_path,
+                              'digest': digest,
+                              'crc': crc,
+                              'size': size,
+                              'tick': self._tick}
+
+        while self._total_bytes() > self._max_bytes:
+            oldest = min(self._entries, key=lambda k: self._entries[k]['tick'])
+            self._remove(oldest)
+
+        self.save()
+
+    def _total_bytes(self):
+        return sum([entry['size'] for entry in self._entries.itervalues()])
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        try:
+            os.remove(entry['payload'])
+        except OSError:
+            pass
@@ -0,0 +1,655 @@
+# Copyright (C) 2009, Justin Lewis  (jtl1728@rit.edu)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import time
+import shutil
+import socket
+import httplib
+import zlib
+import zipfile
+import threading
+import simplejson
+import gobject
+
+import logging
+_logger = logging.getLogger('fileshare-activity.Downloader')
+
+# Size of each read from the connection
+CHUNK_SIZE = 16 * 1024
+
+# Bytes written between saving the verified offset of a partial download
+CHECKPOINT_SIZE = 256 * 1024
+
+# Seconds to wait on a silent connection before giving up
+TIMEOUT = 30
+
+# Times a broken transfer is resumed before reporting an error
+MAX_RETRIES = 3
+RETRY_DELAY = 2
+
+# Times a busy server is asked again, waiting twice as long each time
+MAX_BUSY_RETRIES = 8
+MAX_RETRY_DELAY = 60
+
+# Connections used by a segmented download and the smallest range worth
+# giving its own connection
+SEGMENTS = 4
+MIN_SEGMENT_SIZE = 256 * 1024
+
+# Orders in which queued downloads are started
+ORDER_SMALLEST_FIRST = 'smallest'
+ORDER_USER = 'user'
+
+# Downloads running at once, in total and from the same peer
+MAX_ACTIVE = 3
+MAX_PER_PEER = 2
+
+# Days a partial download is kept without being resumed
+PARTIAL_MAX_AGE = 7
+
+class DownloadError(Exception): pass
+class HTTPStatusError(DownloadError): pass
+class FileChangedError(DownloadError): pass
+
+class ServerBusyError(DownloadError):
+    def __init__(self, message, retry_after=None):
+        DownloadError.__init__(self, message)
+        self.retry_after = retry_after
+
+class PartialStore(object):
+    """
+    Keeps partially downloaded bundles on disk along with the offset up to
+    which they have been flushed, so transfers can resume after an error or
+    an activity restart.
+    """
+    def __init__(self, path):
+        self._path = path
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+
+    def part_path(self, file_id):
+        return os.path.join(self._path, '%s.part' % file_id)
+
+    def _state_path(self, file_id):
+        return os.path.join(self._path, '%s.json' % file_id)
+
+    def load_state(self, file_id):
+        """Returns the saved state of a partial download, {} if none"""
+        if not os.path.exists(self.part_path(file_id)):
+            return {}
+        try:
+            return simplejson.loads(open(self._state_path(file_id), 'rb').read())
+        except Exception:
+            return {}
+
+    def save_state(self, file_id, state):
+        state_path = self._state_path(file_id)
+        fd = open(state_path + '.tmp', 'wb')
+        try:
+            fd.write(simplejson.dumps(state))
+        finally:
+            fd.close()
+        os.rename(state_path + '.tmp', state_path)
+
+    def load(self, file_id):
+        """Returns (offset, validator) of the partial file, 0 if none"""
+        state = self.load_state(file_id)
+        try:
+            offset = int(state['offset'])
+            validator = state['validator']
+        except (KeyError, TypeError, ValueError):
+            return 0, None
+
+        if os.path.getsize(self.part_path(file_id)) < offset:
+            return 0, None
+        return offset, validator
+
+    def checkpoint(self, file_id, offset, validator):
+        self.save_state(file_id, {'offset': offset, 'validator': validator})
+
+    def discard(self, file_id):
+        for path in (self.part_path(file_id), self._state_path(file_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def prune(self, max_age=PARTIAL_MAX_AGE):
+        """Removes partial downloads untouched for max_age days"""
+        limit = time.time() - max_age * 24 * 60 * 60
+        removed = 0
+        for name in os.listdir(self._path):
+            path = os.path.join(self._path, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            _logger.debug("Removed %d stale partial download files", removed)
+        return removed
+
+class ResumableDownloader(gobject.GObject):
+    """
+    Downloads a file over HTTP in a worker thread, resuming partial data
+    with Range/If-Range requests.  Emits the same signals as
+    sugar.network.GlibURLDownloader, from the main loop.  If progress_cb
+    is given it receives (file_id, bytes) from the worker thread instead
+    of 'progress' being emitted for every chunk.
+    """
+    __gsignals__ = {
+        'finished': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE,
+                     ([gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT])),
+        'error': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE,
+                  ([gobject.TYPE_PYOBJECT])),
+        'progress': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE,
+                     ([gobject.TYPE_PYOBJECT]))
+    }
+
+    def __init__(self, host, port, file_id, store, progress_cb=None):
+        gobject.GObject.__init__(self)
+        self._host = host
+        self._port = port
+        self._file_id = file_id
+        self._store = store
+        self._progress_cb = progress_cb
+        self._cancelled = False
+
+    def start(self, dest_path):
+        self._dest_path = dest_path
+        thread = threading.Thread(target=self._run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def cancel(self):
+        self._cancelled = True
+
+    def _emit(self, *args):
+        gobject.idle_add(self.emit, *args)
+
+    def _progress(self, nbytes):
+        if self._progress_cb:
+            self._progress_cb(self._file_id, nbytes)
+        else:
+            self._emit('progress', nbytes)
+
+    def _run(self):
+        retries = 0
+        busy = 0
+        while True:
+            try:
+                self._download()
+            except HTTPStatusError, e:
+                # The server answered, trying again won't help
+                self._emit('error', str(e))
+                return
+            except ServerBusyError, e:
+                if self._cancelled:
+                    return
+                busy += 1
+                if busy > MAX_BUSY_RETRIES:
+                    _logger.debug("Download of %s failed: %s", self._file_id, e)
+                    self._emit('error', str(e))
+                    return
+                delay = retry_delay(busy, e.retry_after)
+                _logger.debug("Server busy for %s, retrying in %ds", self._file_id, delay)
+                time.sleep(delay)
+            except (socket.error, httplib.HTTPException, DownloadError), e:
+                if self._cancelled:
+                    return
+                retries += 1
+                if retries > MAX_RETRIES:
+                    _logger.debug("Download of %s failed: %s", self._file_id, e)
+                    self._emit('error', str(e))
+                    return
+                _logger.debug("Resuming download of %s after: %s", self._file_id, e)
+                time.sleep(retry_delay(retries))
+            except EnvironmentError, e:
+                # Local disk trouble such as a full disk, retrying won't help
+                _logger.warn("Download of %s failed: %s", self._file_id, e)
+                self._emit('error', str(e))
+                return
+            else:
+                if not self._cancelled:
+                    self._emit('finished', self._dest_path,
+                               os.path.basename(self._dest_path))
+                return
+
+    def _download(self):
+        offset, validator = self._store.load(self._file_id)
+
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes=%d-' % offset
+            if validator:
+                headers['If-Range'] = validator
+
+        conn = httplib.HTTPConnection(self._host, self._port, timeout=TIMEOUT)
+        try:
+            conn.request('GET', '/%s' % self._file_id, headers=headers)
+            response = conn.getresponse()
+
+            if response.status == 206:
+                start = parse_content_range(response.getheader('Content-Range'))
+                if start != offset:
+                    raise DownloadError('Unexpected range %s' % start)
+            elif response.status == 200:
+                # Server ignored the range or the file changed, start over
+                offset = 0
+            elif response.status == 416:
+                # Either everything was already received or the file changed
+                if parse_content_length(response.getheader('Content-Range')) != offset:
+                    self._store.discard(self._file_id)
+                    raise DownloadError('Partial download no longer valid')
+            else:
+                raise status_error(response)
+
+            if response.status != 416:
+                return self._complete(response, offset)
+        finally:
+            conn.close()
+
+        self._finish()
+
+    def _complete(self, response, offset):
+        """Receives the rest of the file from response and moves it in place"""
+        validator = response.getheader('ETag') or response.getheader('Last-Modified')
+        length = response.getheader('Content-Length')
+        if length is not None:
+            length = offset + int(length)
+
+        offset = self._receive(response, offset, validator)
+        if length is not None and offset != length:
+            raise DownloadError('Connection closed at %d of %d bytes' % (offset, length))
+        self._finish()
+
+    def _finish(self):
+        """Verifies the part file and moves it in place"""
+        part_path = self._store.part_path(self._file_id)
+        self._verify(part_path)
+        shutil.move(part_path, self._dest_path)
+        self._store.discard(self._file_id)
+
+    def _verify(self, part_path):
+        """Checks the CRC of every member of the received bundle"""
+        try:
+            zip_file = zipfile.ZipFile(part_path)
+            try:
+                bad = zip_file.testzip()
+            finally:
+                zip_file.close()
+        except (zipfile.BadZipfile, zlib.error), e:
+            bad = str(e)
+
+        if bad is not None:
+            self._store.discard(self._file_id)
+            raise DownloadError('Received file is corrupt: %s' % bad)
+
+    def _receive(self, response, offset, validator):
+        part_path = self._store.part_path(self._file_id)
+        if os.path.exists(part_path):
+            fd = open(part_path, 'r+b')
+        else:
+            fd = open(part_path, 'wb')
+
+        try:
+            fd.seek(offset)
+            fd.truncate()
+            checkpoint = offset
+            self._progress(offset)
+
+            while not self._cancelled:
+                data = response.read(CHUNK_SIZE)
+                if not data:
+                    break
+                fd.write(data)
+                offset += len(data)
+                self._progress(offset)
+
+                if offset - checkpoint >= CHECKPOINT_SIZE:
+                    self._checkpoint(fd, offset, validator)
+                    checkpoint = offset
+        finally:
+            # Whatever made it to disk can be resumed from
+            self._checkpoint(fd, offset, validator)
+            fd.close()
+
+        if self._cancelled:
+            raise DownloadError('Cancelled')
+        return offset
+
+    def _checkpoint(self, fd, offset, validator):
+        fd.flush()
+        os.fsync(fd.fileno())
+        self._store.checkpoint(self._file_id, offset, validator)
+
+class SegmentedDownloader(ResumableDownloader):
+    """
+    Splits a download into byte ranges fetched at the same time over several
+    connections, spread across every address given (one per accepted stream
+    tube).  Each range is resumable on its own.  Falls back to a single
+    stream when the server doesn't support ranges or the file is small.
+    """
+    def __init__(self, addrs, file_id, store, progress_cb=None, segments=SEGMENTS):
+        ResumableDownloader.__init__(self, addrs[0][0], addrs[0][1], file_id,
+                                     store, progress_cb)
+        self._addrs = addrs
+        self._segments = segments
+
+    def _download(self):
+        state = self._store.load_state(self._file_id)
+        if not state.get('segments'):
+            conn = httplib.HTTPConnection(self._host, self._port, timeout=TIMEOUT)
+            try:
+                conn.request('GET', '/%s' % self._file_id, headers={'Range': 'bytes=0-0'})
+                response = conn.getresponse()
+                if response.status == 200:
+                    # No range support, the probe already carries the whole file
+                    return self._complete(response, 0)
+                response.read()
+            finally:
+                conn.close()
+
+            state = self._plan(state, response)
+            if state is None:
+                return ResumableDownloader._download(self)
+            self._store.save_state(self._file_id, state)
+
+        self._state = state
+        self._lock = threading.Lock()
+        self._errors = []
+        self._abort = False
+
+        # Bytes of each segment known to be on disk, only these are saved
+        self._flushed = [done for start, end, done in state['segments']]
+
+        part_path = self._store.part_path(self._file_id)
+        fd = open(part_path, 'r+b')
+        try:
+            fd.truncate(state['size'])
+        finally:
+            fd.close()
+
+        self._progress(self._received())
+
+        threads = []
+        for i in range(len(state['segments'])):
+            start, end, done = state['segments'][i]
+            if start + done > end:
+                continue
+            host, port = self._addrs[i % len(self._addrs)]
+            thread = threading.Thread(target=self._fetch_segment,
+                                      args=(i, str(host), int(port)))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        if self._cancelled:
+            raise DownloadError('Cancelled')
+
+        changed = [e for e in self._errors if isinstance(e, FileChangedError)]
+        if changed:
+            # Only safe once no segment can save its state again
+            self._store.discard(self._file_id)
+            raise changed[0]
+        if self._errors:
+            # Prefer reporting errors that retrying won't fix, then a busy
+            # server so the retry backs off
+            self._errors.sort(key=lambda e: (not isinstance(e, HTTPStatusError),
+                                             not isinstance(e, ServerBusyError)))
+            raise self._errors[0]
+
+        size = self._state['size']
+        if self._received() != size or os.path.getsize(part_path) != size:
+            self._store.discard(self._file_id)
+            raise DownloadError('Reassembled file is corrupt')
+        self._finish()
+
+    def _plan(self, state, response):
+        """Splits the file into segments from the reply to a one byte probe"""
+        if response.status != 206:
+            raise status_error(response)
+
+        size = parse_content_length(response.getheader('Content-Range'))
+        validator = response.getheader('ETag') or response.getheader('Last-Modified')
+        if size is None or size < 2 * MIN_SEGMENT_SIZE or not validator:
+            return None
+
+        # Keep data from an earlier single stream attempt on the same file
+        offset = 0
+        if state.get('validator') == validator:
+            offset = min(int(state.get('offset', 0)), size)
+
+        segments = []
+        if offset > 0:
+            segments.append([0, offset - 1, offset])
+
+        remaining = size - offset
+        count = max(1, min(self._segments, remaining / MIN_SEGMENT_SIZE))
+        for i in range(count):
+            start = offset + i * remaining / count
+            end = offset + (i + 1) * remaining / count - 1
+            segments.append([start, end, 0])
+
+        part_path = self._store.part_path(self._file_id)
+        if offset == 0 or not os.path.exists(part_path):
+            open(part_path, 'wb').close()
+
+        return {'size': size, 'validator': validator, 'segments': segments}
+
+    def _received(self):
+        return sum([done for start, end, done in self._state['segments']])
+
+    def _fetch_segment(self, index, host, port):
+        segment = self._state['segments'][index]
+        start, end = segment[0], segment[1]
+        validator = self._state['validator']
+        response = None
+
+        try:
+            conn = httplib.HTTPConnection(host, port, timeout=TIMEOUT)
+            try:
+                conn.request('GET', '/%s' % self._file_id, headers={
+                    'Range': 'bytes=%d-%d' % (start + segment[2], end),
+                    'If-Range': validator})
+                response = conn.getresponse()
+
+                if response.status == 200:
+                    # File changed on the server, the partial data is useless
+                    raise FileChangedError('File changed during download')
+                if response.status != 206:
+                    raise status_error(response)
+                if parse_content_range(response.getheader('Content-Range')) != start + segment[2]:
+                    raise DownloadError('Unexpected range for segment %d' % index)
+
+                self._receive_segment(index, response, segment)
+            finally:
+                conn.close()
+
+            if start + segment[2] <= end:
+                raise DownloadError('Segment %d ended early' % index)
+        except Exception, e:
+            self._errors.append(e)
+            if isinstance(e, (HTTPStatusError, FileChangedError)):
+                # No point letting the other segments carry on
+                self._abort = True
+
+    def _receive_segment(self, index, response, segment):
+        fd = open(self._store.part_path(self._file_id), 'r+b')
+        try:
+            fd.seek(segment[0] + segment[2])
+            unsaved = 0
+            try:
+                while not (self._cancelled or self._abort):
+                    data = response.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    data = data[:segment[1] - segment[0] - segment[2] + 1]
+                    fd.write(data)
+                    unsaved += len(data)
+
+                    self._lock.acquire()
+                    try:
+                        segment[2] += len(data)
+                        received = self._received()
+                    finally:
+                        self._lock.release()
+                    self._progress(received)
+
+                    if unsaved >= CHECKPOINT_SIZE:
+                        self._save_segment(fd, index)
+                        unsaved = 0
+            finally:
+                self._save_segment(fd, index)
+        finally:
+            fd.close()
+
+    def _save_segment(self, fd, index):
+        fd.flush()
+        os.fsync(fd.fileno())
+        self._lock.acquire()
+        try:
+            self._flushed[index] = self._state['segments'][index][2]
+            segments = [[start, end, self._flushed[i]] for i, (start, end, done)
+                        in enumerate(self._state['segments'])]
+            self._store.save_state(self._file_id, {
+                                   'size': self._state['size'],
+                                   'validator': self._state['validator'],
+                                   'segments': segments})
+        finally:
+            self._lock.release()
+
+class DownloadQueue(gobject.GObject):
+    """
+    Holds requested downloads and starts them a few at a time.
+
+    start_cb(file_id) is called from the main loop when a download may
+    begin and returns False if it couldn't be started.  The owner must
+    call finished() once it completes or fails.  'changed' is emitted
+    whenever the queue moves so the UI can show it.
+    """
+    __gsignals__ = {
+        'changed': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, ([]))
+    }
+
+    def __init__(self, start_cb, max_active=MAX_ACTIVE,
+                 max_per_peer=MAX_PER_PEER, order=ORDER_SMALLEST_FIRST):
+        gobject.GObject.__init__(self)
+        self._start_cb = start_cb
+        self.max_active = max_active
+        self.max_per_peer = max_per_peer
+        self.order = order
+
+        self._pending = []
+        self._active = {}
+        self._seq = 0
+
+    def add(self, file_id, size, peer):
+        if self.has(file_id):
+            return
+        self._seq += 1
+        self._pending.append((file_id, size, peer, self._seq))
+        self._schedule()
+        self.emit('changed')
+
+    def remove(self, file_id):
+        """Drops a download that hasn't started yet"""
+        pending = [item for item in self._pending if item[0] != file_id]
+        if len(pending) != len(self._pending):
+            self._pending = pending
+            self.emit('changed')
+
+    def finished(self, file_id):
+        if self._active.has_key(file_id):
+            del self._active[file_id]
+            self._schedule()
+            self.emit('changed')
+
+    def has(self, file_id):
+        return self._active.has_key(file_id) or \
+               file_id in [item[0] for item in self._pending]
+
+    def get_active(self):
+        return self._active.keys()
+
+    def get_queued(self):
+        """Returns the waiting file ids in the order they will start"""
+        return [item[0] for item in self._ordered()]
+
+    def _ordered(self):
+        if self.order == ORDER_SMALLEST_FIRST:
+            key = lambda item: (item[1], item[3])
+        else:
+            key = lambda item: item[3]
+        return sorted(self._pending, key=key)
+
+    def _peer_load(self, peer):
+        return len([p for p in self._active.values() if p == peer])
+
+    def _schedule(self):
+        for item in self._ordered():
+            if len(self._active) >= self.max_active:
+                break
+            file_id, size, peer, seq = item
+            if self._peer_load(peer) >= self.max_per_peer:
+                continue
+
+            self._pending.remove(item)
+            self._active[file_id] = peer
+            try:
+                started = self._start_cb(file_id)
+            except Exception:
+                _logger.exception("Could not start download of %s", file_id)
+                started = False
+            if not started:
+                del self._active[file_id]
+
+def status_error(response):
+    """Returns the exception for a response with an unexpected status"""
+    if response.status == 503:
+        try:
+            retry_after = int(response.getheader('Retry-After'))
+        except (TypeError, ValueError):
+            retry_after = None
+        return ServerBusyError('Server busy', retry_after)
+    return HTTPStatusError('HTTP error %d' % response.status)
+
+def retry_delay(attempt, retry_after=None):
+    """Seconds to wait before the given retry, doubling every attempt"""
+    delay = RETRY_DELAY * 2 ** (attempt - 1)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return min(delay, MAX_RETRY_DELAY)
+
+def parse_content_range(value):
+    """Returns the first byte of a 'bytes start-end/total' header"""
+    try:
+        unit, spec = value.split(' ', 1)
+        return int(spec.split('-', 1)[0])
+    except (AttributeError, ValueError):
+        raise DownloadError('Bad Content-Range %r' % value)
+
+def parse_content_length(value):
+    """Returns the total size from a 'bytes start-end/total' header"""
+    try:
+        return int(value.rsplit('/', 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return None
@@ -25,6 +25,7 @@ class FileInfo(object):
         self.size = size
         self.had_file = have_file
         self.installed = have_file
+        self.stale = False
 
         if have_file:
             self.aquired = size
@@ -49,6 +50,36 @@ class FileInfo(object):
         else:
             self.status="%s %d%% (%d %s)"%(_("Downloading"), self.percent, aquired_size, _("bytes"))
 
+    def update_uploaded(self, sent_size, rate, eta):
+        if self.size:
+            self.percent = (float(sent_size)/float(self.size))*100.0
+        else:
+            self.percent = 100
+        self.status = "%s %d%% (%d %s" % (_("Uploading"), self.percent, rate / 1024, _("KB/s"))
+        if eta is not None:
+            self.status += ", %d:%02d %s" % (eta / 60, eta % 60, _("left"))
+        self.status += ")"
+
+    def set_upload_queued(self):
+        self.status = _("Waiting to Upload")
+        self.percent = 0
+
+    def set_uploaded(self):
+        self.status = _("Uploaded to Server")
+        self.percent = 100
+
+    def set_stale(self):
+        self.stale = True
+        self.status = _("Cached, Checking...")
+
+    def set_current(self):
+        if self.stale:
+            self.stale = False
+            self.status = _("Pending")
+
+    def set_queued(self, position):
+        self.status = "%s (%d)" % (_("Queued"), position)
+
     def set_installed(self):
         self.status = _("Download Complete")
         self.aquired = self.size
@@ -0,0 +1,358 @@
+# Copyright (C) 2009, Justin Lewis  (jtl1728@rit.edu)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import time
+import mmap
+import errno
+import select
+import socket
+import threading
+import Queue
+import SocketServer
+import SimpleHTTPServer
+import gobject
+
+import logging
+_logger = logging.getLogger('fileshare-activity.FileServer')
+
+# Bytes handed to the socket per send call
+CHUNK_SIZE = 64 * 1024
+
+# Threads serving requests and the most connections allowed to wait for one.
+# A worker is held for a whole transfer and a client fetching MAX_PER_PEER
+# segmented downloads uses eight, so this serves two such clients at once.
+MAX_WORKERS = 16
+MAX_WAITING = 16
+
+# Seconds a connection may wait for a worker, kept below the client timeout
+# so it gets a 503 it can retry rather than timing out
+MAX_QUEUE_WAIT = 20
+
+# Seconds clients are asked to wait before retrying a 503
+RETRY_AFTER = 5
+
+# Seconds a client may stall before its connection is dropped
+TIMEOUT = 60
+
+class RangeFile(object):
+    """
+    Byte range of a file to be sent to a client.  Python 2 has no
+    os.sendfile, so send_to() writes buffers over an mmap of the file
+    straight to the socket and only falls back to reading it through
+    Python strings when the file can't be mapped.
+    """
+    def __init__(self, fd, offset, length):
+        self._fd = fd
+        self._offset = offset
+        self.remaining = length
+        self._map = None
+
+        if length > 0:
+            try:
+                self._map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, mmap.error):
+                self._map = None
+
+    def read(self, size):
+        self._fd.seek(self._offset)
+        data = self._fd.read(min(size, self.remaining))
+        self._offset += len(data)
+        self.remaining -= len(data)
+        return data
+
+    def send_to(self, out_fd, size):
+        """Writes up to size bytes to out_fd, returns the number written"""
+        size = min(size, self.remaining)
+        if size <= 0:
+            return 0
+
+        if self._map is not None:
+            sent = os.write(out_fd, buffer(self._map, self._offset, size))
+        else:
+            self._fd.seek(self._offset)
+            sent = os.write(out_fd, self._fd.read(size))
+
+        self._offset += sent
+        self.remaining -= sent
+        return sent
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._fd.close()
+
+class BundleRange(object):
+    """
+    Byte range of a bundle given as its parts, strings and a (path, size)
+    for the payload file.  Strings are sent from memory and the payload
+    through a RangeFile, so it still goes out of an mmap.
+    """
+    def __init__(self, parts, offset, length):
+        self.remaining = length
+        self._pieces = []
+        try:
+            for part in parts:
+                if isinstance(part, tuple):
+                    size = part[1]
+                else:
+                    size = len(part)
+                if offset >= size:
+                    offset -= size
+                    continue
+
+                count = min(size - offset, length)
+                if count <= 0:
+                    break
+                if isinstance(part, tuple):
+                    self._pieces.append(RangeFile(open(part[0], 'rb'), offset, count))
+                else:
+                    self._pieces.append(part[offset:offset + count])
+                offset = 0
+                length -= count
+        except EnvironmentError:
+            self.close()
+            raise
+
+    def send_to(self, out_fd, size):
+        """Writes up to size bytes to out_fd, returns the number written"""
+        while self._pieces:
+            piece = self._pieces[0]
+            if isinstance(piece, RangeFile):
+                if piece.remaining == 0:
+                    piece.close()
+                    self._pieces.pop(0)
+                    continue
+                sent = piece.send_to(out_fd, size)
+            else:
+                if not piece:
+                    self._pieces.pop(0)
+                    continue
+                sent = os.write(out_fd, buffer(piece, 0, size))
+                self._pieces[0] = piece[sent:]
+            self.remaining -= sent
+            return sent
+        return 0
+
+    def close(self):
+        for piece in self._pieces:
+            if isinstance(piece, RangeFile):
+                piece.close()
+        self._pieces = []
+
+class FileRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serves shared bundles, runs in one of the file server's workers"""
+    def setup(self):
+        self.request.settimeout(TIMEOUT)
+        SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+
+    def log_message(self, format, *args):
+        _logger.debug("%s - %s", self.client_address[0], format % args)
+
+    def translate_path(self, path):
+        return self.server._pathBuilder( path )
+
+    def do_GET(self):
+        """Serve a GET request."""
+        source = self.send_head()
+        if not source:
+            return
+
+        file_id = self.path[1:]
+        self.server.report('start', file_id, 0)
+        length = source.remaining
+        try:
+            try:
+                self.copyfile(source, self.wfile)
+            except (EnvironmentError, socket.error), e:
+                _logger.debug("Error sending %s: %s", file_id, e)
+                self.server.report('failed', file_id, length - source.remaining)
+            else:
+                self.server.report('done', file_id, length)
+        finally:
+            source.close()
+
+    def copyfile(self, source, outputfile):
+        outputfile.flush()
+        out_fd = outputfile.fileno()
+        while source.remaining > 0:
+            try:
+                if not source.send_to(out_fd, CHUNK_SIZE):
+                    break
+            except EnvironmentError, e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+                # Socket is full, wait for the client to catch up
+                if not select.select([], [out_fd], [], TIMEOUT)[1]:
+                    raise socket.timeout('Client stalled')
+
+    def send_head(self):
+        """Sends the headers for a whole bundle or a single byte range"""
+        bundle = self.translate_path(self.path)
+        if not bundle:
+            self.send_error(404, "File not found")
+            return None
+
+        size = bundle.size
+        etag = bundle.etag
+
+        start = 0
+        end = size - 1
+        status = 200
+
+        # Only honour the range if the client's copy is of this same file
+        range_header = self.headers.getheader('Range')
+        if_range = self.headers.getheader('If-Range')
+        if range_header and (not if_range or if_range == etag):
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                byte_range = (start, end)
+            else:
+                status = 206
+
+            if byte_range is None:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            start, end = byte_range
+
+        try:
+            source = BundleRange(bundle.parts(), start, end - start + 1)
+        except EnvironmentError:
+            # Stopped being shared meanwhile
+            self.send_error(404, "File not found")
+            return None
+
+        self.send_response(status)
+        self.send_header("Content-Type", self.guess_type(bundle.name))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.date_time_string(bundle.mtime))
+        if status == 206:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        self.end_headers()
+
+        return source
+
+class FileServer(SocketServer.TCPServer):
+    """
+    HTTP server for shared bundles that runs outside the GTK main loop.
+    pathBuilder(path) returns the bundle to serve for a request path, or
+    None.
+
+    One thread accepts connections and hands them to a fixed pool of
+    workers, so a busy class can't slow down the UI.  Connections beyond
+    MAX_WAITING, or waiting longer than MAX_QUEUE_WAIT, get a 503.
+    status_cb(event, file_id, bytes) is called on the main loop with
+    'start', 'done' or 'failed' for each transfer.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, server_address, pathBuilder, status_cb=None,
+                 workers=MAX_WORKERS):
+        self._pathBuilder = pathBuilder
+        self._status_cb = status_cb
+        self._workers = workers
+        self._requests = Queue.Queue()
+        SocketServer.TCPServer.__init__(self, server_address, FileRequestHandler)
+
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def process_request(self, request, client_address):
+        if self._requests.qsize() >= MAX_WAITING:
+            _logger.debug("Too many connections, turning away %s", client_address)
+            self._turn_away(request)
+            return
+        self._requests.put((request, client_address, time.time()))
+
+    def _turn_away(self, request):
+        try:
+            request.sendall("HTTP/1.0 503 Service Unavailable\r\n"
+                            "Retry-After: %d\r\n\r\n" % RETRY_AFTER)
+        except socket.error:
+            pass
+        self.close_request(request)
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address, queued = item
+            if time.time() - queued > MAX_QUEUE_WAIT:
+                _logger.debug("%s waited too long, turning away", client_address)
+                self._turn_away(request)
+                continue
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.close_request(request)
+
+    def handle_error(self, request, client_address):
+        _logger.exception("Error serving %s", client_address)
+
+    def report(self, event, file_id, nbytes):
+        if self._status_cb:
+            gobject.idle_add(self._status_cb, event, file_id, nbytes)
+
+    def stop(self):
+        self.shutdown()
+        for i in range(self._workers):
+            self._requests.put(None)
+        self.server_close()
+
+def parse_range(value, size):
+    """
+    Parses a single 'bytes=' Range header against a file of size bytes.
+    Returns (start, end) inclusive, None if the range can't be satisfied
+    and raises ValueError for headers that should be ignored.
+    """
+    unit, spec = value.split('=', 1)
+    if unit.strip() != 'bytes' or ',' in spec:
+        raise ValueError(value)
+
+    first, last = spec.strip().split('-', 1)
+    if first == '':
+        # Suffix range, the last n bytes
+        length = int(last)
+        if length <= 0:
+            return None
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    if last == '':
+        end = size - 1
+    else:
+        end = min(int(last), size - 1)
+        if end < start:
+            raise ValueError(value)
+
+    if start >= size:
+        return None
+    return start, end
@@ -20,6 +20,7 @@ import simplejson
 import tempfile
 import os
 import time
+import shutil
 import journalentrybundle
 import dbus
 import gobject
@@ -30,7 +31,6 @@ from gettext import gettext as _
 from sugar.activity.activity import Activity
 
 from sugar.presence.tubeconn import TubeConnection
-from sugar import network
 from sugar import profile
 
 from GuiView import GuiView
@@ -38,9 +38,16 @@ from MyExceptions import InShareException, FileUploadFailure, ServerRequestFailu
 
 from TubeSpeak import TubeSpeak
 import FileInfo
-from hashlib import sha1
-
-import urllib, urllib2, MultipartPostHandler, httplib
+import Catalog
+import ContentHash
+import BlobStore
+import Downloader
+import FileServer
+import Progress
+
+import ServerClient
+import CatalogCache
+import Uploader
 import threading
 
 import logging
@@ -51,14 +58,8 @@ IFACE = SERVICE
 PATH = "/org/laptop/FileShare"
 DIST_STREAM_SERVICE = 'fileshare-activity-http'
 
-class MyHTTPRequestHandler(network.ChunkedGlibHTTPRequestHandler):
-    def translate_path(self, path):
-        return self.server._pathBuilder( path )
-
-class MyHTTPServer(network.GlibTCPServer):
-    def __init__(self, server_address, pathBuilder):
-        self._pathBuilder = pathBuilder
-        network.GlibTCPServer.__init__(self, server_address, MyHTTPRequestHandler)
+# Seconds catalog changes are collected before the cached copy is rewritten
+CATALOG_SAVE_DELAY = 2
 
 class FileShareActivity(Activity):
     def __init__(self, handle):
@@ -74,6 +75,47 @@ class FileShareActivity(Activity):
         temp_path = os.path.join(self.get_activity_root(), 'instance')
         self._filepath = tempfile.mkdtemp(dir=temp_path)
 
+        # Payloads are kept once in a content addressed store and shared
+        # entries link to them, blobs left over from earlier sessions are
+        # dropped
+        self._blobs = BlobStore.BlobStore(os.path.join(temp_path, 'blobs'))
+        self._blobs.collect()
+        self._shares = BlobStore.ShareStore(self._filepath, self._blobs)
+
+        # Index of objects packaged in earlier sessions
+        data_path = os.path.join(self.get_activity_root(), 'data')
+        self._hashIndex = ContentHash.HashIndex(
+                            os.path.join(data_path, 'hashindex.json'),
+                            os.path.join(data_path, 'packaged'))
+
+        # Last file lists seen, revalidated rather than fetched again
+        self._catalogCache = CatalogCache.CatalogCache(os.path.join(data_path, 'catalogs'))
+
+        # Cache key of the catalog being followed, entries shown from the
+        # cache but not yet confirmed, and the pending cache write
+        self._catalogKey = None
+        self._stale = set()
+        self._catalogSave = None
+
+        # Partial downloads kept so they can be resumed, abandoned ones dropped
+        self._partials = Downloader.PartialStore(os.path.join(data_path, 'partial'))
+        self._partials.prune()
+
+        # Download progress, shown at a fixed rate rather than per chunk
+        self._progress = Progress.ProgressAggregator(self._download_progress_cb)
+
+        # Progress and measured rate of uploads to the school server
+        self._uploadProgress = Progress.ProgressAggregator(self._upload_progress_cb)
+        self._uploadRates = {}
+
+        # Ids of bundles being packaged, build_file may run on several threads
+        self._building = set()
+        self._buildLock = threading.Lock()
+
+        # Requested downloads waiting for a free slot
+        self._downloads = Downloader.DownloadQueue(self._start_download)
+        self._downloads.connect('changed', self._download_queue_changed_cb)
+
         # Set if they started the activity
         self.isServer = not self._shared_activity
 
@@ -81,14 +123,17 @@ class FileShareActivity(Activity):
         self.port = 1024 + (hash(self._activity_id) % 64511)
 
         # Data structures for holding file list
-        self.sharedFiles = {}
+        self.sharedFiles = Catalog.Catalog()
 
         # Holds the controll tube
         self.controlTube = None
 
-        # Holds tubes for transfers
+        # Serves shared files to peers once the activity is shared
+        self._fileserver = None
+
+        # Holds tubes for transfers and the addresses of accepted ones
         self.unused_download_tubes = set()
-        self.addr=None
+        self.download_addrs = []
 
         # Are we the ones that created the control tube
         self.initiating = False
@@ -103,6 +148,7 @@ class FileShareActivity(Activity):
         self._user_nick = profile.get_nick_name()
         self._user_permissions = 0
         self.server_ip = None
+        self._server = None
 
         jabber_serv = None
         prof = profile.get_profile()
@@ -120,6 +166,9 @@ class FileShareActivity(Activity):
             self.server_port= 14623
             self.s_version = 0
 
+            # Keep-alive connections shared by every request to the server
+            self._server = ServerClient.ServerClient(self.server_ip, self.server_port)
+
 
         # INITIALIZE GUI
         ################
@@ -170,21 +219,23 @@ class FileShareActivity(Activity):
             # Rebuild gui, now we are in server mode
             self.disp.build_toolbars()
 
+            # Show the list last seen from this server until it is refreshed
+            self._catalogKey = None
+            self._loadCachedCatalog( self._server_cache_key() )
+
             #self.set_canvas(self.disp)
             #self.show_all()
 
             #IN SERVER MODE, GET SERVER FILE LIST
             def call():
                 try:
-                    conn = httplib.HTTPConnection( self.server_ip, self.server_port)
-                    conn.request("GET", "/filelist")
-                    r1 = conn.getresponse()
-                    if r1.status == 200:
-                        data = r1.read()
-                        conn.close()
-                        self.incomingRequest('filelist',data)
+                    status, filelist = CatalogCache.fetch_filelist(self._server,
+                                            self._catalogCache, self._server_cache_key(),
+                                            self._server_page_cb)
+                    if filelist is None:
+                        self.disp.guiHandler._alert(str(status), _("Error getting file list") )
                     else:
-                        self.disp.guiHandler._alert(str(r1.status), _("Error getting file list") )
+                        gobject.idle_add(self._markCatalogCurrent, filelist)
                 except:
                     self.disp.guiHandler._alert(_("Error getting file list"))
                 self.disp.guiHandler.show_throbber(False)
@@ -192,16 +243,22 @@ class FileShareActivity(Activity):
             self.disp.guiHandler.show_throbber(True, _("Requesting file list from server"))
             threading.Thread(target=call).start()
 
+    def _server_cache_key(self):
+        return 'server:%s:%d' % (self.server_ip, self.server_port)
+
+    def _server_page_cb(self, page):
+        # Called from the fetching thread, add the entries in the main loop
+        gobject.idle_add(self._applyServerPage, page)
+
+    def _applyServerPage(self, page):
+        self._applyCatalogChange( page.values(), [] )
+        return False
+
     def check_for_server(self):
         s_version = None
         try:
-            conn = httplib.HTTPConnection( self.server_ip, self.server_port)
-            conn.request("GET", "/version")
-            r1 = conn.getresponse()
-            if r1.status == 200:
-                s_version= r1.read()
-                conn.close()
-
+            status, s_version = self._server.get("/version")
+            if status == 200:
                 if int(s_version) >= 2:
                     # Version 2 supports permissions, announce user so server
                     # can cache user info and be added to the access list if allowed
@@ -210,9 +267,7 @@ class FileShareActivity(Activity):
                                 'nick': self._user_nick
                               }
                     try:
-                        opener = urllib2.build_opener( MultipartPostHandler.MultipartPostHandler)
-                        f = opener.open("http://%s:%d/announce_user"%(self.server_ip, self.server_port), params)
-                        self._user_permissions = int(f.read())
+                        self._user_permissions = int(self._server_post("/announce_user", params))
                     except:
                         raise ServerRequestFailure
 
@@ -226,12 +281,22 @@ class FileShareActivity(Activity):
         except:
             return False
 
+    def _server_post(self, path, params, progress_cb=None):
+        """Posts to the school server and returns the response body"""
+        try:
+            status, data = self._server.post(path, params, progress_cb)
+        except Exception, e:
+            _logger.warn("Server request %s failed: %s", path, e)
+            raise ServerRequestFailure
+        if status / 100 != 2:
+            _logger.warn("Server request %s failed: HTTP %d", path, status)
+            raise ServerRequestFailure
+        return data
+
     def get_server_user_list(self):
         params =  { 'id': self._user_key_hash }
+        response = self._server_post("/user_list", params)
         try:
-            opener = urllib2.build_opener( MultipartPostHandler.MultipartPostHandler)
-            f = opener.open("http://%s:%d/user_list"%(self.server_ip, self.server_port), params)
-            response = f.read()
             return simplejson.loads(response)
         except Exception:
             raise ServerRequestFailure
@@ -241,67 +306,164 @@ class FileShareActivity(Activity):
                    'userid': userId,
                    'level': level
                  }
-        try:
-            opener = urllib2.build_opener( MultipartPostHandler.MultipartPostHandler)
-            f = opener.open("http://%s:%d/user_mod"%(self.server_ip, self.server_port), params)
-        except:
-            raise ServerRequestFailure
+        self._server_post("/user_mod", params)
 
     def build_file(self, jobject):
+        file_path = jobject.get_file_path()
+        metadata = jobject.get_metadata()
+        meta_hash = journalentrybundle.metadata_hash(metadata)
+
+        # Check if this exact object was packaged before
+        cached = None
+        if file_path and jobject.object_id:
+            cached = self._hashIndex.lookup(jobject.object_id, file_path, meta_hash)
+
         #If object has activity id and it is filled in, use that as hash
         if jobject.metadata.has_key("activity_id") and str(jobject.metadata['activity_id']):
             objectHash = str(jobject.metadata['activity_id'])
-            bundle_path = os.path.join(self._filepath, '%s.xoj' % objectHash)
 
-            # If file in share, return don't build file
-            if os.path.exists(bundle_path):
-                raise InShareException()
+        # Unchanged file found in the index, no need to hash it again
+        elif cached:
+            objectHash = str(cached['hash'])
+
+        # Unknown activity id, must be a file
+        elif file_path:
+            # FIXME: This just checks the file hash should check for
+            # identity by compairing metadata, but this will work for now
+            # Problems are that if you have one file multiple times it will
+            # only allow one copy of that file regardless of the metadata
+            objectHash = ContentHash.hash_file(file_path)
 
         else:
-            # Unknown activity id, must be a file
-            if jobject.get_file_path():
-                # FIXME: This just checks the file hash should check for
-                # identity by compairing metadata, but this will work for now
-                # Problems are that if you have one file multiple times it will
-                # only allow one copy of that file regardless of the metadata
-                objectHash = sha1(open(jobject.get_file_path() ,'rb').read()).hexdigest()
-                bundle_path = os.path.join(self._filepath, '%s.xoj' % objectHash)
-
-                if os.path.exists(bundle_path):
-                    raise InShareException()
+            # UNKOWN ACTIVTIY, No activity id, no file hash, just add it
+            # FIXME
+            _logger.warn("Unknown File Data. Can't check if file is already shared.")
+            objectHash = sha1(str(time.time())).hexdigest()
 
-            else:
-                # UNKOWN ACTIVTIY, No activity id, no file hash, just add it
-                # FIXME
-                _logger.warn("Unknown File Data. Can't check if file is already shared.")
-                objectHash = sha1(time.time()).hexdigest()
-                bundle_path = os.path.join(self._filepath, '%s.xoj' % objectHash)
+        # If file in share or being packaged, return don't build file
+        self._buildLock.acquire()
+        try:
+            if self.sharedFiles.has_key(objectHash) or self._shares.has(objectHash) \
+                    or objectHash in self._building:
+                raise InShareException()
+            self._building.add(objectHash)
+        finally:
+            self._buildLock.release()
 
-        journalentrybundle.from_jobject(jobject, bundle_path )
+        try:
+            entry_id, encoded, preview = journalentrybundle.split_metadata(metadata)
+            if cached and cached['hash'] == objectHash:
+                _logger.debug("Reusing packaged payload %s", cached['payload'])
+                bundle = self._shares.add(objectHash, entry_id, encoded, preview,
+                            cached['payload'],
+                            (cached['digest'], cached['crc'], cached['size']))
+            else:
+                bundle = self._shares.add(objectHash, entry_id, encoded, preview,
+                                          file_path)
+                if file_path and jobject.object_id:
+                    payload_path, size, crc, digest = bundle.payload
+                    self._hashIndex.store(jobject.object_id, file_path, meta_hash,
+                                          objectHash, payload_path, (digest, crc, size))
+        finally:
+            self._buildLock.acquire()
+            self._building.discard(objectHash)
+            self._buildLock.release()
 
         # Build file information
         desc =  "" if not jobject.metadata.has_key('description') else str( jobject.metadata['description'] )
         title = _("Untitled") if str(jobject.metadata['title']) == "" else str(jobject.metadata['title'])
         tags = "" if not jobject.metadata.has_key('tags') else str( jobject.metadata['tags'] )
-        size = os.path.getsize( bundle_path )
+        size = bundle.size
 
         #File Info Block
         return FileInfo.FileInfo(objectHash, title, desc, tags, size, True)
 
     def send_file_to_server(self, id, file_info):
-        bundle_path = os.path.join(self._filepath, '%s.xoj' % id)
+        bundle = self._shares.get(id)
+        if bundle is None:
+            raise FileUploadFailure()
+        bundle_file = bundle.open()
         params = { 'jdata': simplejson.dumps(file_info.share_dump()),
-                    'file':  open(bundle_path, 'rb')
+                    'file':  bundle_file
                 }
 
         if self.s_version >= 2:
             params['id'] = self._user_key_hash
 
+        def progress(sent):
+            self._uploadProgress.record(id, sent)
+
+        self._uploadRates[id] = Progress.TransferRate(file_info.size)
         try:
-            opener = urllib2.build_opener( MultipartPostHandler.MultipartPostHandler)
-            opener.open("http://%s:%d/upload"%(self.server_ip, self.server_port), params)
-        except:
-            raise FileUploadFailure()
+            try:
+                # Body is streamed from the bundle as it is sent
+                self._server_post("/upload", params, progress)
+            except ServerRequestFailure:
+                raise FileUploadFailure()
+        finally:
+            bundle_file.close()
+            self._uploadProgress.finish(id)
+            gobject.idle_add(self._upload_done, id)
+
+    def upload_objects(self, jobjects):
+        """Packages and uploads a batch of journal objects to the server"""
+        # Ask the datastore for paths and metadata here, the objects keep
+        # them so build_file makes no D-Bus calls on the packaging threads
+        for jobject in jobjects:
+            jobject.get_file_path()
+            jobject.get_metadata()
+
+        batch = {'uploaded': 0, 'failed': 0, 'skipped': 0}
+        uploader = Uploader.BatchUploader(self.build_file,
+                lambda file_info: self.send_file_to_server(file_info.id, file_info),
+                lambda *args: self._upload_status_cb(batch, *args))
+        uploader.start(jobjects)
+
+    def _upload_status_cb(self, batch, event, jobject, file_info, error):
+        if event == 'packaged' or (event == 'failed' and file_info is None):
+            # Packaging is over, drop the datastore's copy of the file
+            jobject.destroy()
+
+        if event == 'packaged':
+            file_info.set_upload_queued()
+            self.disp.guiHandler._addFileToUIList( file_info.id, file_info )
+            self._registerShareFile( file_info.id, file_info )
+
+        elif event == 'uploaded':
+            batch['uploaded'] += 1
+            self.disp.set_uploaded( file_info.id )
+
+        elif event == 'failed':
+            if file_info is None:
+                if isinstance(error, InShareException):
+                    batch['skipped'] += 1
+                else:
+                    _logger.warn("Could not package object: %s", error)
+                    batch['failed'] += 1
+            else:
+                # Roll back only this object
+                batch['failed'] += 1
+                self.disp.guiHandler._remFileFromUIList( file_info.id )
+                self._unregisterShareFile( file_info.id )
+                self.delete_file( file_info.id )
+
+        elif event == 'done':
+            if batch['failed'] or batch['skipped']:
+                self.disp.guiHandler._alert(_("Upload finished"),
+                        _("%d uploaded, %d failed, %d already shared") %
+                        (batch['uploaded'], batch['failed'], batch['skipped']))
+        return False
+
+    def _upload_progress_cb(self, fileId, bytes_sent):
+        rate = self._uploadRates.get(fileId)
+        if rate:
+            rate.update(bytes_sent)
+            self.disp.update_upload(fileId, bytes_sent, rate.rate(), rate.eta())
+
+    def _upload_done(self, fileId):
+        if self._uploadRates.has_key(fileId):
+            del self._uploadRates[fileId]
+        return False
 
     def remove_file_from_server( self, file_id ):
         params =  { 'fid': file_id }
@@ -309,54 +471,48 @@ class FileShareActivity(Activity):
         if self.s_version >= 2:
             params['id'] = self._user_key_hash
 
-        try:
-            opener = urllib2.build_opener( MultipartPostHandler.MultipartPostHandler)
-            opener.open("http://%s:%d/remove"%(self.server_ip, self.server_port), params)
-        except:
-            raise ServerRequestFailure
+        self._server_post("/remove", params)
 
 
     def updateFileObj( self, key, file_obj ):
-        if self.sharedFiles.has_key( key ):
-            self.sharedFiles[key] = file_obj
+        self.sharedFiles.update( key, file_obj )
 
     def _registerShareFile( self, key, file_obj ):
-        self.sharedFiles[key] = file_obj
+        self.sharedFiles.add( key, file_obj )
 
         # Notify connected users
-        if self.initiating:
-                self.controlTube.FileAdd( simplejson.dumps(fileinfo.share_dump()) )
+        if self.initiating and self.controlTube:
+            self.controlTube.queue_changes()
 
     def _unregisterShareFile( self, key ):
-        del self.sharedFiles[key]
+        self.sharedFiles.remove( key )
+
+        # Nothing left to download once the file is no longer listed
+        self._downloads.remove( key )
 
         # Notify connected users
-        if self.initiating:
-            self.controlTube.FileRem( simplejson.dumps(id) )
+        if self.initiating and self.controlTube:
+            self.controlTube.queue_changes()
 
 
 
     def delete_file( self, id ):
-        bundle_path = os.path.join(self._filepath, '%s.xoj' % id)
         try:
-            os.remove( bundle_path )
+            self._shares.remove( id )
         except:
-            _logger.warn("Could not remove file from system: %s",bundle_path)
+            _logger.warn("Could not remove file from system: %s", id)
 
     def server_ui_del_overide(self):
         return self.isServer or self._mode=="SERVER"
 
     def getFileList(self):
-        ret = {}
-        for key in self.sharedFiles:
-            ret[key] = self.sharedFiles[key].share_dump()
-        return simplejson.dumps(ret)
+        return self.sharedFiles.encode_snapshot()
 
-    def filePathBuilder(self, path):
+    def sharedBundle(self, path):
         if self.sharedFiles.has_key( path[1:] ):
-            return os.path.join(self._filepath, '%s.xoj' % path[1:])
+            return self._shares.get( path[1:] )
         else:
-            _logger.debug("INVALID PATH",path[1:])
+            _logger.debug("INVALID PATH %s",path[1:])
 
     def _shared_cb(self, activity):
         _logger.debug('Activity is now shared')
@@ -387,6 +543,74 @@ class FileShareActivity(Activity):
         # The server will send us the file list and then we
         # can use any new tubes to download the file
 
+        # Show the list last seen in this share until the sharer answers,
+        # resuming from its version so only missed changes are sent
+        self._catalogKey = 'share:%s' % self._activity_id
+        etag = self._loadCachedCatalog( self._catalogKey )
+        if etag:
+            catalog_id, version = etag.rsplit(':', 1)
+            self.sharedFiles.sync_to( catalog_id, int(version) )
+
+    def _loadCachedCatalog(self, key):
+        """Adds the cached list of key marked stale, returns its etag"""
+        etag, filelist = self._catalogCache.load( key )
+        if filelist is None:
+            return None
+
+        entries = []
+        for dump in filelist.values():
+            if not self.sharedFiles.has_key(dump[0]):
+                fi = FileInfo.share_load( dump )
+                fi.set_stale()
+                self._registerShareFile( fi.id, fi )
+                self._stale.add( fi.id )
+                entries.append( (fi.id, fi) )
+        self.disp.guiHandler._addFilesToUIList( entries )
+        _logger.debug("Showing %d cached entries of %s", len(entries), key)
+        return etag
+
+    def _markCatalogCurrent(self, listed=None):
+        """Confirms stale entries, dropping those missing from listed"""
+        if not self._stale:
+            return False
+
+        removed = []
+        refreshed = []
+        for key in self._stale:
+            if not self.sharedFiles.has_key(key):
+                continue
+            fi = self.sharedFiles[key]
+            if listed is not None and not listed.has_key(key) and fi.aquired == 0:
+                removed.append(key)
+            else:
+                fi.set_current()
+                refreshed.append(key)
+        self._stale = set()
+
+        self.disp.guiHandler._remFilesFromUIList( removed )
+        for key in removed:
+            self._unregisterShareFile( key )
+        self.disp.refresh_rows( refreshed )
+        return False
+
+    def _queueCatalogSave(self):
+        if self._catalogKey and self._catalogSave is None:
+            self._catalogSave = gobject.timeout_add(CATALOG_SAVE_DELAY * 1000,
+                                                    self._saveCatalog)
+
+    def _saveCatalog(self):
+        self._catalogSave = None
+
+        # Version lets the next session ask the sharer for a delta
+        etag = None
+        if self.controlTube and self.controlTube.versioned:
+            etag = '%s:%d' % (self.sharedFiles.catalog_id, self.sharedFiles.version)
+        try:
+            self._catalogCache.save_encoded( self._catalogKey, etag,
+                                             self.sharedFiles.encode_snapshot() )
+        except (IOError, OSError), e:
+            _logger.warn("Could not cache catalog: %s", e)
+        return False
 
 
     def watch_for_tubes(self):
@@ -407,7 +631,8 @@ class FileShareActivity(Activity):
         # instead of IPv4 (might be more compatible with Rainbow)
 
         # Create a fileserver to serve files
-        self._fileserver = MyHTTPServer(("", self.port), self.filePathBuilder)
+        self._fileserver = FileServer.FileServer(("", self.port), self.sharedBundle,
+                                                 self._fileserver_status_cb)
 
         # Make a tube for it
         chan = self._shared_activity.telepathy_tubes_chan
@@ -418,42 +643,73 @@ class FileShareActivity(Activity):
                 ('127.0.0.1', dbus.UInt16(self.port)),
                 telepathy.SOCKET_ACCESS_CONTROL_LOCALHOST, 0)
 
+    def queue_download(self, file_info):
+        if self._mode == 'SERVER':
+            peer = self.server_ip
+        else:
+            peer = 'sharer'
+        self._downloads.add(file_info.id, file_info.size, peer)
+
+    def _start_download(self, fileId):
+        try:
+            if self._mode == 'SERVER':
+                self._server_download_document(fileId)
+            else:
+                self._get_document(fileId)
+        except NoFreeTubes:
+            self.disp.guiHandler._alert(_("All tubes are busy, file download cannot start"),_("Please wait and try again"))
+            self.disp.set_installed(fileId, False)
+            return False
+        return True
+
+    def _download_queue_changed_cb(self, queue):
+        position = 1
+        for fileId in queue.get_queued():
+            self.disp.set_queued(fileId, position)
+            position += 1
+
+    def _fileserver_status_cb(self, event, fileId, nbytes):
+        _logger.debug("File server: %s %s (%d bytes)", event, fileId, nbytes)
+
     def _server_download_document( self, fileId ):
         addr = [self.server_ip, self.server_port]
-        self._download_document(addr, fileId)
+        self._download_document([addr], fileId)
         # Download the file at next avaialbe time.
         #gobject.idle_add(self._download_document, addr, fileId)
         #return False
 
 
     def _get_document(self,fileId):
-        if not self.addr:
-            try:
-                tube_id = self.unused_download_tubes.pop()
-            except (ValueError, KeyError), e:
-                _logger.debug('No tubes to get the document from right now: %s', e)
-                raise NoFreeTubes()
+        # Accept every data tube offered so far, each one is another
+        # path the download can be spread over
+        while self.unused_download_tubes:
+            tube_id = self.unused_download_tubes.pop()
 
             # FIXME: should ideally have the CM listen on a Unix socket
             # instead of IPv4 (might be more compatible with Rainbow)
             chan = self._shared_activity.telepathy_tubes_chan
             iface = chan[telepathy.CHANNEL_TYPE_TUBES]
-            self.addr = iface.AcceptStreamTube(tube_id,
+            addr = iface.AcceptStreamTube(tube_id,
                     telepathy.SOCKET_ADDRESS_TYPE_IPV4,
                     telepathy.SOCKET_ACCESS_CONTROL_LOCALHOST, 0,
                     utf8_strings=True)
 
-            _logger.debug('Accepted stream tube: listening address is %r', self.addr)
+            _logger.debug('Accepted stream tube: listening address is %r', addr)
             # SOCKET_ADDRESS_TYPE_IPV4 is defined to have addresses of type '(sq)'
-            assert isinstance(self.addr, dbus.Struct)
-            assert len(self.addr) == 2
-            assert isinstance(self.addr[0], str)
-            assert isinstance(self.addr[1], (int, long))
-            assert self.addr[1] > 0 and self.addr[1] < 65536
+            assert isinstance(addr, dbus.Struct)
+            assert len(addr) == 2
+            assert isinstance(addr[0], str)
+            assert isinstance(addr[1], (int, long))
+            assert addr[1] > 0 and addr[1] < 65536
+            self.download_addrs.append(addr)
+
+        if not self.download_addrs:
+            _logger.debug('No tubes to get the document from right now')
+            raise NoFreeTubes()
 
         # Download the file at next avaialbe time.
-        self._download_document(self.addr, fileId)
-        #gobject.idle_add(self._download_document, self.addr, fileId)
+        self._download_document(self.download_addrs, fileId)
+        #gobject.idle_add(self._download_document, self.download_addrs, fileId)
         #return False
 
     def _list_tubes_reply_cb(self, tubes):
@@ -476,7 +732,8 @@ class FileShareActivity(Activity):
                 group_iface=self.tubes_chan[telepathy.CHANNEL_INTERFACE_GROUP])
 
             self.controlTube = TubeSpeak(tube_conn, self.initiating,
-                                         self.incomingRequest, self.getFileList)
+                                         self.incomingRequest, self.getFileList,
+                                         self.sharedFiles)
         elif (type == telepathy.TUBE_TYPE_STREAM and service == DIST_STREAM_SERVICE):
                 # Data tube, store for later
                 _logger.debug("New data tube added")
@@ -485,37 +742,60 @@ class FileShareActivity(Activity):
 
     def incomingRequest(self,action,request):
         if action == "filelist":
-            filelist = simplejson.loads( request )
-            for key in filelist:
-                if not self.sharedFiles.has_key(key):
-                    fi = FileInfo.share_load(filelist[key])
-                    self.disp.guiHandler._addFileToUIList(fi.id, fi)
-                    # Register File with activity share list
-                    self._registerShareFile( fi.id, fi )
+            self._applyCatalogSnapshot( simplejson.loads( request ).values() )
         elif action == "fileadd":
-            addList = simplejson.loads( request )
-            fi = FileInfo.share_load( addList )
-            self.disp.guiHandler._addFileToUIList( fi.id, fi )
-            self._registerShareFile( fi.id, fi )
+            self._applyCatalogChange( [simplejson.loads( request )], [] )
         elif action == "filerem":
-            id =  simplejson.loads( request )
-            # DO NOT DELETE IF TRANSFER IN PROGRESS/COMPLETE
-            if self.fileShare[id].aquired == 0:
-                self.disp.guiHandler._remFileFromUIList( id )
-                # UnRegister File with activity share list
-                self._unregisterShareFile( key )
+            self._applyCatalogChange( [], [simplejson.loads( request )] )
+        elif action == "catalog_snapshot":
+            self._applyCatalogSnapshot( simplejson.loads( request ).values() )
+        elif action == "catalog_delta":
+            delta = simplejson.loads( request )
+            self._applyCatalogChange( delta['add'], delta['rem'] )
+        elif action == "catalog_snapshot_records":
+            self._applyCatalogSnapshot( request[0] )
+        elif action == "catalog_delta_records":
+            self._applyCatalogChange( request[0], request[1] )
 
         else:
             _logger.debug("Incoming tube Request: %s. Data: %s" % (action, request) )
+            return
 
-    def _download_document(self, addr, documentId):
+        # The sharer answered, entries still shown from the cache are current
+        self._markCatalogCurrent()
+        self._queueCatalogSave()
+
+    def _applyCatalogSnapshot(self, added):
+        keep = set([dump[0] for dump in added])
+        removed = [key for key in self.sharedFiles if key not in keep]
+        self._applyCatalogChange( added, removed )
+
+    def _applyCatalogChange(self, added, removed):
+        # DO NOT DELETE IF TRANSFER IN PROGRESS/COMPLETE
+        removed = [key for key in removed
+                   if self.sharedFiles.has_key(key) and self.sharedFiles[key].aquired == 0]
+        self.disp.guiHandler._remFilesFromUIList( removed )
+        for key in removed:
+            # UnRegister File with activity share list
+            self._unregisterShareFile( key )
+
+        entries = []
+        for dump in added:
+            if not self.sharedFiles.has_key(dump[0]):
+                fi = FileInfo.share_load( dump )
+                # Register File with activity share list
+                self._registerShareFile( fi.id, fi )
+                entries.append( (fi.id, fi) )
+        self.disp.guiHandler._addFilesToUIList( entries )
+
+    def _download_document(self, addrs, documentId):
         _logger.debug('Requesting to download document')
         bundle_path = os.path.join(self._filepath, '%s.xoj' % documentId)
-        port = int(addr[1])
+        addrs = [(str(addr[0]), int(addr[1])) for addr in addrs]
 
-        getter = network.GlibURLDownloader("http://%s:%d/%s" % (addr[0], port,documentId))
+        getter = Downloader.SegmentedDownloader(addrs, documentId, self._partials,
+                                                self._progress.record)
         getter.connect("finished", self._download_result_cb, documentId)
-        getter.connect("progress", self._download_progress_cb, documentId)
         getter.connect("error", self._download_error_cb, documentId)
         _logger.debug("Starting download to %s...", bundle_path)
         getter.start(bundle_path)
@@ -523,33 +803,39 @@ class FileShareActivity(Activity):
 
     def _download_result_cb(self, getter, tmp_file, suggested_name, fileId):
         _logger.debug("Got document %s (%s)", tmp_file, suggested_name)
+        self._downloads.finished(fileId)
+        self._progress.finish(fileId)
 
         try:
-            metadata = self._installBundle( tmp_file )
+            # Keep it shared from the store rather than as a bundle
+            self._shares.add_bundle( fileId, tmp_file )
+            metadata = self.install_file( fileId )
             self.disp.guiHandler._alert( _("File Downloaded"), metadata['title'])
             self.disp.set_installed( fileId )
         except:
             self.disp.guiHandler._alert( _("File Download Failed") )
             self.disp.set_installed( fileId, False )
 
-    def _download_progress_cb(self, getter, bytes_downloaded, fileId):
+    def _download_progress_cb(self, fileId, bytes_downloaded):
         self.disp.update_progress( fileId, bytes_downloaded )
 
-        # Force gui to update if there are actions pending
-        # Fixes bug where system appears to hang on FAST connections
-        while gtk.events_pending():
-            gtk.main_iteration()
-
     def _download_error_cb(self, getter, err, fileId):
         _logger.debug("Error getting document from tube. %s",  err )
+        self._downloads.finished(fileId)
+        self._progress.finish(fileId)
         self.disp.guiHandler._alert(_("Error getting document"), err)
+
+        # Allow the download to be requested again, it resumes where it stopped
+        self.disp.set_installed(fileId, False)
         #gobject.idle_add(self._get_document)
 
 
-    def _installBundle(self, tmp_file):
-        """Installs a file to the journal"""
-        _logger.debug("Saving %s to datastore...", tmp_file)
-        bundle = journalentrybundle.JournalEntryBundle(tmp_file)
+    def install_file(self, id):
+        """Installs a shared file to the journal, returns its metadata"""
+        _logger.debug("Saving %s to datastore...", id)
+        bundle = self._shares.get(id)
+        if bundle is None:
+            raise journalentrybundle.MalformedBundleException('%s is not stored' % id)
         bundle.install()
         return bundle.get_metadata()
 
@@ -557,6 +843,11 @@ class FileShareActivity(Activity):
     def can_close( self ):
         #TODO: HAVE SERVER CHECK IF IT CAN CLOSE
         self._close_requested = True
+        if self._server:
+            self._server.close()
+        if self._fileserver:
+            self._fileserver.stop()
+            self._fileserver = None
         return True
 
     def write_file(self, file_path):
@@ -589,8 +880,12 @@ class FileShareActivity(Activity):
 
         # Save, requested, write files into zip and save file list
         try:
-            for name in os.listdir(self._filepath):
-                file.write(os.path.join( self._filepath, name), name, zipfile.ZIP_DEFLATED)
+            # Bundles are assembled straight into the zip, deflating them
+            # a second time would only cost CPU
+            for id in self._shares.ids():
+                bundle = self._shares.get(id)
+                if bundle:
+                    bundle.write_to(file, '%s.xoj' % id)
 
             file.writestr("_filelist.json", self.getFileList())
         finally:
@@ -608,7 +903,16 @@ class FileShareActivity(Activity):
             # Only extract and add files that we have (needed if client when saved)
             if fileName in namelist:
                 bundle_path = os.path.join(self._filepath, fileName)
-                open(bundle_path, "wb").write(zip_file.read(fileName))
+                src = zip_file.open(fileName)
+                try:
+                    dst = open(bundle_path, "wb")
+                    try:
+                        shutil.copyfileobj(src, dst)
+                    finally:
+                        dst.close()
+                finally:
+                    src.close()
+                self._shares.add_bundle(key, bundle_path)
 
                 fi = FileInfo.share_load(filelist[key], True)
                 self._addFileToUIList(fi.id, fi)
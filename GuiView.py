@@ -15,6 +15,7 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import gtk
+import gobject
 import FileInfo
 import threading
 from gettext import gettext as _
@@ -29,6 +30,16 @@ from MyExceptions import InShareException, FileUploadFailure, ServerRequestFailu
 import logging
 _logger = logging.getLogger('fileshare-activity')
 
+# Rows inserted at once when a file list arrives, the rest are streamed
+BULK_STREAM_THRESHOLD = 500
+
+# Inserting more rows than this detaches the model from the view first,
+# which loses the selection and scroll position
+BULK_DETACH_THRESHOLD = 50
+
+# Rows added per idle callback for the rest of a large file list
+BULK_BATCH_SIZE = 100
+
 class GuiHandler():
     def __init__(self, activity, tree, handle):
         self.activity = activity
@@ -39,6 +50,25 @@ class GuiHandler():
     def requestAddFile(self, widget, data=None):
         _logger.info('Requesting to add file')
 
+        # Upload to server? After each pick they are asked whether to add
+        # another, the objects are then packaged and uploaded as one batch
+        if data and data.has_key('upload'):
+            jobjects = []
+            while True:
+                chooser = ObjectChooser()
+                accepted = chooser.run() == gtk.RESPONSE_ACCEPT
+                if accepted:
+                    jobjects.append( chooser.get_selected_object() )
+                chooser.destroy()
+                del chooser
+
+                if not accepted or not self._ask_add_another():
+                    break
+
+            if jobjects:
+                self.activity.upload_objects( jobjects )
+            return
+
         chooser = ObjectChooser()
         if chooser.run() == gtk.RESPONSE_ACCEPT:
             # get object and build file
@@ -51,6 +81,11 @@ class GuiHandler():
                 self._alert(_("Object Not Added"), _("Object already shared"))
                 self.show_throbber( False )
                 return
+            except Exception, e:
+                _logger.exception("Could not package object")
+                self._alert(_("Object Not Added"), _("Object could not be packaged"))
+                self.show_throbber( False )
+                return
 
             # No problems continue
             self.show_throbber( False )
@@ -61,22 +96,17 @@ class GuiHandler():
             # Register File with activity share list
             self.activity._registerShareFile( file_obj.id, file_obj )
 
-            # Upload to server?
-            if data and data.has_key('upload'):
-                self.show_throbber(True, _("Uploading Object to server"))
-                def send():
-                    try:
-                        self.activity.send_file_to_server( file_obj.id, file_obj )
-                    except FileUploadFailure:
-                        self._alert( _("Failed to upload object") )
-                        self._remFileFromUIList( file_obj.id )
-                        self.activity.delete_file( file_obj.id )
-                    self.show_throbber( False )
-                threading.Thread(target=send).start()
-
         chooser.destroy()
         del chooser
 
+    def _ask_add_another(self):
+        dialog = gtk.MessageDialog(self.activity, gtk.DIALOG_MODAL,
+                gtk.MESSAGE_QUESTION, gtk.BUTTONS_YES_NO,
+                _("Add another object to this upload?"))
+        response = dialog.run()
+        dialog.destroy()
+        return response == gtk.RESPONSE_YES
+
     def requestInsFile(self, widget, data=None):
         _logger.info('Requesting to install file back to journal')
 
@@ -85,10 +115,7 @@ class GuiHandler():
             iter = model.get_iter(path)
             key = model.get_value(iter, 0)
 
-            # Attempt to remove file from system
-            bundle_path = os.path.join(self._filepath, '%s.xoj' % key)
-
-            self.activity._installBundle( bundle_path )
+            self.activity.install_file( key )
             self._alert(_("Installed bundle to Jorunal"))
 
     def requestRemFile(self, widget, data=None):
@@ -96,32 +123,34 @@ class GuiHandler():
         _logger.info('Requesting to delete file')
 
         model, iterlist = self.treeview.get_selection().get_selected_rows()
+        keys = []
         for path in iterlist:
             iter = model.get_iter(path)
-            key = model.get_value(iter, 0)
 
             # DO NOT DELETE IF TRANSFER IN PROGRESS/COMPLETE
             if model.get_value(iter, 1).aquired == 0 or self.activity.server_ui_del_overide():
+                keys.append(model.get_value(iter, 0))
 
-                # Remove file from UI
-                self._remFileFromUIList(key)
+        # Remove files from UI, after collecting them as paths shift on removal
+        self.guiView.remove_rows(keys)
 
-                # UnRegister File with activity share list
-                self.activity._unregisterShareFile( key )
+        for key in keys:
+            # UnRegister File with activity share list
+            self.activity._unregisterShareFile( key )
 
-                # Attempt to remove file from system
-                self.activity.delete_file( key )
+            # Attempt to remove file from system
+            self.activity.delete_file( key )
 
-                # If added by rem from server button, data will have remove key
-                if data and data.has_key('remove'):
-                    def call():
-                        try:
-                            self.activity.remove_file_from_server( key )
-                        except ServerRequestFailure:
-                            self._alert( _("Failed to send remove request to server") )
-                        self.show_throbber( False )
-                    self.show_throbber(True, _("Sending request to server"))
-                    threading.Thread(target=call).start()
+            # If added by rem from server button, data will have remove key
+            if data and data.has_key('remove'):
+                def call(key):
+                    try:
+                        self.activity.remove_file_from_server( key )
+                    except ServerRequestFailure:
+                        self._alert( _("Failed to send remove request to server") )
+                    self.show_throbber( False )
+                self.show_throbber(True, _("Sending request to server"))
+                threading.Thread(target=call, args=(key,)).start()
 
     def requestDownloadFile(self, widget, data=None):
         _logger.info('Requesting to Download file')
@@ -130,34 +159,25 @@ class GuiHandler():
             for path in iterlist:
                 iter = model.get_iter(path)
                 fi = model.get_value(iter, 1)
-                def do_down():
-                    if fi.aquired == 0:
-                        if self.activity._mode == 'SERVER':
-                            self.activity._server_download_document( str( model.get_value(iter, 0)) )
-                        else:
-                            try:
-                                self.activity._get_document(str( model.get_value(iter, 0)))
-                            except NoFreeTubes:
-                                self._alert(_("All tubes are busy, file download cannot start"),_("Please wait and try again"))
-                    else:
-                        self._alert(_("Object has already or is currently being downloaded"))
-                threading.Thread(target=do_down).start()
+                if fi.aquired == 0:
+                    self.activity.queue_download( fi )
+                else:
+                    self._alert(_("Object has already or is currently being downloaded"))
         else:
             self._alert(_("You must select an object to download"))
 
 
     def _addFileToUIList(self, fileid, fileinfo):
-        modle = self.treeview.get_model()
-        modle.append( None, [fileid, fileinfo])
+        self.guiView.add_row(fileid, fileinfo)
+
+    def _addFilesToUIList(self, entries):
+        self.guiView.load_rows(entries)
 
     def _remFileFromUIList(self, id):
-        model = self.treeview.get_model()
-        iter = model.get_iter_first()
-        while iter:
-            if model.get_value( iter, 0 ) == id:
-                break
-            iter = model.iter_next( iter )
-        model.remove( iter )
+        self.guiView.remove_rows([id])
+
+    def _remFilesFromUIList(self, ids):
+        self.guiView.remove_rows(ids)
 
 
 
@@ -289,7 +309,15 @@ class GuiView(gtk.ScrolledWindow):
         gtk.ScrolledWindow.__init__(self)
         self.set_policy( gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC )
         self.activity = activity
-        self.treeview = gtk.TreeView(gtk.TreeStore(str,object))
+        self.treeview = gtk.TreeView(gtk.ListStore(str,object))
+
+        # Row of every file id, so rows are found without scanning the model
+        self._rows = {}
+
+        # Rows of a large file list still waiting to be streamed in
+        self._pending = []
+        self._load_source = None
+
         self.guiHandler = GuiHandler( activity, self.treeview, self )
         #self.build_table(activity)
 
@@ -414,15 +442,90 @@ class GuiView(gtk.ScrolledWindow):
         # Put table into scroll window to allow it to scroll
         self.add_with_viewport(self.treeview)
 
-    def clear_files(self, deleteFile = True):
+    def _append_row(self, model, fileid, fileinfo):
+        iter = model.append([fileid, fileinfo])
+        self._rows[fileid] = gtk.TreeRowReference(model, model.get_path(iter))
+
+    def add_row(self, fileid, fileinfo):
+        self._append_row(self.treeview.get_model(), fileid, fileinfo)
+
+    def load_rows(self, entries):
+        """
+        Adds a list of (id, fileinfo) rows. The first BULK_STREAM_THRESHOLD
+        rows are inserted at once, with the model detached from the view if
+        there are more than BULK_DETACH_THRESHOLD, the rest are streamed in
+        idle-time batches.
+        """
+        entries = list(entries)
+        if not entries:
+            return
+
+        if not self._pending:
+            model = self.treeview.get_model()
+            batch = entries[:BULK_STREAM_THRESHOLD]
+            detach = len(batch) > BULK_DETACH_THRESHOLD
+            if detach:
+                self.treeview.set_model(None)
+            try:
+                for fileid, fileinfo in batch:
+                    self._append_row(model, fileid, fileinfo)
+            finally:
+                if detach:
+                    self.treeview.set_model(model)
+            entries = entries[BULK_STREAM_THRESHOLD:]
+
+        self._pending.extend(entries)
+        if self._pending and self._load_source is None:
+            self._load_source = gobject.idle_add(self._load_batch)
+
+    def _load_batch(self):
         model = self.treeview.get_model()
-        iter = model.get_iter_root()
-        while iter:
-            key = model.get_value(iter, 0)
+        for fileid, fileinfo in self._pending[:BULK_BATCH_SIZE]:
+            self._append_row(model, fileid, fileinfo)
+        del self._pending[:BULK_BATCH_SIZE]
+
+        if self._pending:
+            return True
+        self._load_source = None
+        return False
+
+    def get_row(self, fileid):
+        """Returns the iter of the row showing fileid, None if not listed"""
+        ref = self._rows.get(fileid)
+        if ref is None or not ref.valid():
+            return None
+        return ref.get_model().get_iter(ref.get_path())
+
+    def remove_rows(self, ids):
+        model = self.treeview.get_model()
+        for fileid in ids:
+            iter = self.get_row(fileid)
+            if iter:
+                model.remove(iter)
+            if self._rows.has_key(fileid):
+                del self._rows[fileid]
+
+        if self._pending:
+            ids = set(ids)
+            self._pending = [entry for entry in self._pending
+                             if entry[0] not in ids]
+
+    def clear_rows(self):
+        if self._load_source is not None:
+            gobject.source_remove(self._load_source)
+            self._load_source = None
+        self._pending = []
+
+        self.treeview.get_model().clear()
+        self._rows = {}
 
-            # Remove file from UI
-            self.guiHandler._remFileFromUIList(key)
+    def clear_files(self, deleteFile = True):
+        keys = self._rows.keys() + [entry[0] for entry in self._pending]
+
+        # Remove files from UI
+        self.clear_rows()
 
+        for key in keys:
             # UnRegister File with activity share list
             self.activity._unregisterShareFile( key )
 
@@ -430,15 +533,9 @@ class GuiView(gtk.ScrolledWindow):
             if deleteFile:
                 self.activity.delete_file( key )
 
-            iter = model.iter_next(iter)
-
     def update_progress(self, id, bytes ):
         model = self.treeview.get_model()
-        iter = model.get_iter_first()
-        while iter:
-            if model.get_value( iter, 0 ) == id:
-                break
-            iter = model.iter_next( iter )
+        iter = self.get_row(id)
 
         if iter:
             obj = model.get_value( iter, 1 )
@@ -448,15 +545,44 @@ class GuiView(gtk.ScrolledWindow):
             self.activity.updateFileObj( id, obj )
             model.set_value( iter, 1, obj)
 
+    def update_upload( self, id, bytes, rate, eta ):
+        model = self.treeview.get_model()
+        iter = self.get_row(id)
+
+        if iter:
+            obj = model.get_value( iter, 1 )
+            obj.update_uploaded( bytes, rate, eta )
+            model.row_changed(model.get_path(iter), iter)
+
+    def set_uploaded( self, id ):
+        model = self.treeview.get_model()
+        iter = self.get_row(id)
+
+        if iter:
+            obj = model.get_value( iter, 1 )
+            obj.set_uploaded()
+            model.row_changed(model.get_path(iter), iter)
+        return False
+
+    def refresh_rows( self, ids ):
+        model = self.treeview.get_model()
+        for id in ids:
+            iter = self.get_row(id)
+            if iter:
+                model.row_changed(model.get_path(iter), iter)
+
+    def set_queued( self, id, position ):
+        model = self.treeview.get_model()
+        iter = self.get_row(id)
+
+        if iter:
+            obj = model.get_value( iter, 1 )
+            obj.set_queued( position )
             model.row_changed(model.get_path(iter), iter)
 
     def set_installed( self, id, sucessful=True ):
         model = self.treeview.get_model()
-        iter = model.get_iter_first()
-        while iter:
-            if model.get_value( iter, 0 ) == id:
-                break
-            iter = model.iter_next( iter )
+        iter = self.get_row(id)
 
         if iter:
             obj = model.get_value( iter, 1 )
@@ -468,4 +594,3 @@ class GuiView(gtk.ScrolledWindow):
             # Store updated versoin of the object
             self.activity.updateFileObj( id, obj )
             model.set_value( iter, 1, obj)
-            model.row_changed(model.get_path(iter), iter)
@@ -51,9 +51,102 @@ class Callable:
 #  assigning a sequence.
 doseq = 1
 
+# Size of the pieces files are read in while the body is sent
+CHUNK_SIZE = 64 * 1024
+
+class MultipartBody:
+    """
+    File-like multipart/form-data body.  The length is known up front and
+    files are read in chunks as the body is read, so httplib streams them
+    to the socket without ever holding a whole file in memory.
+
+    progress_cb, if given, is called with the number of file bytes read so
+    far each time a chunk of a file is handed out.
+    """
+    def __init__(self, vars, files, boundary = None, progress_cb = None):
+        if boundary is None:
+            boundary = mimetools.choose_boundary()
+        self.boundary = boundary
+        self.progress_cb = progress_cb
+        self.file_bytes = 0
+
+        # Parts are either byte strings or (file, size) pairs
+        self._parts = []
+        for(key, value) in vars:
+            part = '--%s\r\nContent-Disposition: form-data; name="%s"' \
+                   '\r\n\r\n%s\r\n' % (boundary, key, value)
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            self._parts.append(part)
+        for(key, fd) in files:
+            if hasattr(fd, 'fileno'):
+                file_size = os.fstat(fd.fileno())[stat.ST_SIZE]
+            else:
+                # Assembled bundles aren't a single file but know their size
+                file_size = fd.size
+            filename = os.path.basename(fd.name)
+            contenttype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            self._parts.append('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                               'Content-Type: %s\r\n\r\n' % (boundary, key, filename, contenttype))
+            self._parts.append((fd, file_size))
+            self._parts.append('\r\n')
+        self._parts.append('--%s--\r\n\r\n' % boundary)
+
+        self.length = 0
+        for part in self._parts:
+            self.length += self._part_length(part)
+
+        self._index = 0
+        self._offset = 0
+
+    def _part_length(self, part):
+        if isinstance(part, tuple):
+            return part[1]
+        return len(part)
+
+    def __len__(self):
+        return self.length
+
+    def rewind(self):
+        """Starts the body over, for sending it again"""
+        self._index = 0
+        self._offset = 0
+        self.file_bytes = 0
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            size = self.length
+
+        chunks = []
+        while size > 0 and self._index < len(self._parts):
+            part = self._parts[self._index]
+            if not isinstance(part, tuple):
+                data = part[self._offset:self._offset + size]
+            else:
+                fd, file_size = part
+                if self._offset == 0:
+                    fd.seek(0)
+                data = fd.read(min(size, file_size - self._offset))
+                if not data:
+                    raise IOError("%s shrank while being sent" % fd.name)
+                self.file_bytes += len(data)
+                if self.progress_cb:
+                    self.progress_cb(self.file_bytes)
+
+            chunks.append(data)
+            size -= len(data)
+            self._offset += len(data)
+            if self._offset >= self._part_length(part):
+                self._index += 1
+                self._offset = 0
+        return ''.join(chunks)
+
 class MultipartPostHandler(urllib2.BaseHandler):
     handler_order = urllib2.HTTPHandler.handler_order - 10 # needs to run first
 
+    def __init__(self, progress_cb = None):
+        self.progress_cb = progress_cb
+
     def http_request(self, request):
         data = request.get_data()
         if data is not None and type(data) != str:
@@ -72,37 +165,20 @@ class MultipartPostHandler(urllib2.BaseHandler):
             if len(v_files) == 0:
                 data = urllib.urlencode(v_vars, doseq)
             else:
-                boundary, data = self.multipart_encode(v_vars, v_files)
+                boundary, data = self.multipart_encode(v_vars, v_files, None, self.progress_cb)
                 contenttype = 'multipart/form-data; boundary=%s' % boundary
                 if(request.has_header('Content-Type')
                    and request.get_header('Content-Type').find('multipart/form-data') != 0):
                     print "Replacing %s with %s" % (request.get_header('content-type'), 'multipart/form-data')
                 request.add_unredirected_header('Content-Type', contenttype)
+                request.add_unredirected_header('Content-Length', '%d' % len(data))
 
             request.add_data(data)
         return request
 
-    def multipart_encode(vars, files, boundary = None, buffer = None):
-        if boundary is None:
-            boundary = mimetools.choose_boundary()
-        if buffer is None:
-            buffer = ''
-        for(key, value) in vars:
-            buffer += '--%s\r\n' % boundary
-            buffer += 'Content-Disposition: form-data; name="%s"' % key
-            buffer += '\r\n\r\n' + value + '\r\n'
-        for(key, fd) in files:
-            file_size = os.fstat(fd.fileno())[stat.ST_SIZE]
-            filename = os.path.basename(fd.name)
-            contenttype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-            buffer += '--%s\r\n' % boundary
-            buffer += 'Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename)
-            buffer += 'Content-Type: %s\r\n' % contenttype
-            # buffer += 'Content-Length: %s\r\n' % file_size
-            fd.seek(0)
-            buffer += '\r\n' + fd.read() + '\r\n'
-        buffer += '--%s--\r\n\r\n' % boundary
-        return boundary, buffer
+    def multipart_encode(vars, files, boundary = None, progress_cb = None):
+        body = MultipartBody(vars, files, boundary, progress_cb)
+        return body.boundary, body
     multipart_encode = Callable(multipart_encode)
 
     https_request = http_request
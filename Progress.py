@@ -0,0 +1,103 @@
+# Copyright (C) 2009, Justin Lewis  (jtl1728@rit.edu)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import time
+import threading
+import gobject
+
+# Times per second the UI is told about transfer progress
+UPDATE_RATE = 10
+
+# Seconds of history the transfer rate is measured over
+RATE_WINDOW = 5.0
+
+class ProgressAggregator(object):
+    """
+    Collects byte counts of running transfers from any thread and hands
+    only the latest count of each to update_cb(transfer_id, bytes), at most
+    UPDATE_RATE times a second from a single main loop timer.
+    """
+    def __init__(self, update_cb, rate=UPDATE_RATE):
+        self._update_cb = update_cb
+        self._interval = 1000 / rate
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def record(self, transfer_id, nbytes):
+        self._lock.acquire()
+        try:
+            self._pending[transfer_id] = nbytes
+            if self._timer is None:
+                self._timer = gobject.timeout_add(self._interval, self._flush)
+        finally:
+            self._lock.release()
+
+    def finish(self, transfer_id):
+        """Drops any update not yet shown so it can't overwrite the final state"""
+        self._lock.acquire()
+        try:
+            if self._pending.has_key(transfer_id):
+                del self._pending[transfer_id]
+        finally:
+            self._lock.release()
+
+    def _flush(self):
+        self._lock.acquire()
+        try:
+            pending = self._pending
+            self._pending = {}
+            if not pending:
+                # Nothing moved since the last tick, stop until next record
+                self._timer = None
+                return False
+        finally:
+            self._lock.release()
+
+        for transfer_id, nbytes in pending.iteritems():
+            self._update_cb(transfer_id, nbytes)
+        return True
+
+class TransferRate(object):
+    """
+    Measures the throughput of one transfer over the last RATE_WINDOW
+    seconds and estimates the time left to reach total bytes.
+    """
+    def __init__(self, total, window=RATE_WINDOW):
+        self.total = total
+        self._window = window
+        self._samples = [(time.time(), 0)]
+
+    def update(self, nbytes):
+        now = time.time()
+        self._samples.append((now, nbytes))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self._window:
+            del self._samples[0]
+
+    def rate(self):
+        """Bytes per second, 0 until some time has passed"""
+        start_time, start_bytes = self._samples[0]
+        end_time, end_bytes = self._samples[-1]
+        if end_time <= start_time:
+            return 0
+        return (end_bytes - start_bytes) / (end_time - start_time)
+
+    def eta(self):
+        """Seconds left at the current rate, None while unknown"""
+        rate = self.rate()
+        if rate <= 0:
+            return None
+        return max(0, self.total - self._samples[-1][1]) / rate
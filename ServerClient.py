@@ -0,0 +1,212 @@
+# Copyright (C) 2009, Justin Lewis  (jtl1728@rit.edu)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import time
+import errno
+import socket
+import urllib
+import httplib
+import threading
+
+import MultipartPostHandler
+
+import logging
+_logger = logging.getLogger('fileshare-activity.ServerClient')
+
+# Idle connections kept open to the server for reuse
+MAX_IDLE = 4
+
+# Seconds an idle connection is reused for, below the usual server
+# keep-alive timeout so requests rarely meet a connection it closed
+IDLE_TIMEOUT = 4
+
+# Default seconds to wait on the server for a request
+TIMEOUT = 30
+
+# Methods safe to send again once the server may have received them
+IDEMPOTENT = ('GET', 'HEAD')
+
+def _closed_by_server(e):
+    """True if e shows an idle connection the server had already closed"""
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    if isinstance(e, socket.timeout) or not isinstance(e, socket.error):
+        return False
+    return bool(e.args) and e.args[0] in (errno.ECONNRESET, errno.EPIPE,
+                                          errno.ECONNABORTED)
+
+class ServerClient(object):
+    """
+    Thread safe HTTP client for the school server.
+
+    Connections are kept alive and handed back to a small pool after each
+    request, so repeated requests skip the TCP handshake.  A request that
+    fails on a reused connection, which the server may have closed while it
+    sat idle, is retried once on a fresh one.  Only failures before any
+    response byte arrived are retried, never timeouts, and requests that
+    aren't idempotent only while their body hasn't been sent.
+    """
+    def __init__(self, host, port, max_idle=MAX_IDLE, timeout=TIMEOUT):
+        self.host = host
+        self.port = port
+        self._max_idle = max_idle
+        self._timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'connections': 0, 'reused': 0, 'failures': 0}
+
+    def _count(self, key):
+        self._lock.acquire()
+        try:
+            self._stats[key] += 1
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        """Returns counts of requests, new connections, reuses and failures"""
+        self._lock.acquire()
+        try:
+            return dict(self._stats)
+        finally:
+            self._lock.release()
+
+    def _get_connection(self, timeout, fresh=False):
+        conn = None
+        expired = []
+        if not fresh:
+            self._lock.acquire()
+            try:
+                while self._idle and conn is None:
+                    conn, released = self._idle.pop()
+                    if time.time() - released > IDLE_TIMEOUT:
+                        expired.append(conn)
+                        conn = None
+            finally:
+                self._lock.release()
+
+        for old in expired:
+            old.close()
+
+        if conn:
+            self._count('reused')
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            return conn, True
+
+        self._count('connections')
+        return httplib.HTTPConnection(self.host, self.port, timeout=timeout), False
+
+    def _release(self, conn):
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self._max_idle:
+                self._idle.append((conn, time.time()))
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+        finally:
+            self._lock.release()
+
+        for conn, released in idle:
+            conn.close()
+        _logger.debug("Closed server client: %s", self.get_stats())
+
+    def request(self, method, path, body=None, headers={}, timeout=None):
+        """Returns (status, data) of the response, raises on network errors"""
+        response, data = self._request(method, path, body, headers, timeout)
+        return response.status, data
+
+    def _request(self, method, path, body, headers, timeout):
+        if timeout is None:
+            timeout = self._timeout
+        self._count('requests')
+
+        retried = False
+        while True:
+            conn, reused = self._get_connection(timeout, retried)
+            start = time.time()
+            sent = False
+            try:
+                conn.request(method, path, body, headers)
+                sent = True
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if reused and not retried and _closed_by_server(e) \
+                        and (not sent or method in IDEMPOTENT):
+                    _logger.debug("Reused connection failed (%s), retrying", e)
+                    if hasattr(body, 'rewind'):
+                        body.rewind()
+                    retried = True
+                    continue
+                self._count('failures')
+                raise
+
+            try:
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                self._count('failures')
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+
+            _logger.debug("%s %s: %d in %.3fs (reused %s)", method, path,
+                          response.status, time.time() - start, reused)
+            return response, data
+
+    def get(self, path, timeout=None):
+        return self.request('GET', path, timeout=timeout)
+
+    def get_with_headers(self, path, headers={}, timeout=None):
+        """Returns (status, response headers, data), header names lower case"""
+        response, data = self._request('GET', path, None, headers, timeout)
+        return response.status, dict(response.getheaders()), data
+
+    def post(self, path, params, progress_cb=None, timeout=None):
+        """
+        Posts params as a form.  Open files, or readers with a name and
+        size, in params are streamed as a multipart body, progress_cb is
+        then told the file bytes sent.
+        """
+        files = []
+        vars = []
+        for key, value in params.items():
+            if hasattr(value, 'read'):
+                files.append((key, value))
+            else:
+                vars.append((key, value))
+
+        if files:
+            body = MultipartPostHandler.MultipartBody(vars, files, None, progress_cb)
+            headers = {'Content-Type': 'multipart/form-data; boundary=%s' % body.boundary,
+                       'Content-Length': '%d' % len(body)}
+        else:
+            body = urllib.urlencode(vars, MultipartPostHandler.doseq)
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+        return self.request('POST', path, body, headers, timeout)
@@ -15,6 +15,8 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import logging
+import gobject
+import simplejson
 from dbus.service import method, signal
 from dbus.gobject_service import ExportedGObject
 
@@ -22,8 +24,48 @@ SERVICE = "org.laptop.FileShare"
 IFACE = SERVICE
 PATH = "/org/laptop/FileShare"
 
+# Seconds to wait for a catalog sync reply before trying an older protocol
+SYNC_TIMEOUT = 5
+
+# Seconds to wait on each older protocol after that.  The first wait already
+# covers a slow link, an initiator that answers at all answers quickly.
+FALLBACK_TIMEOUT = 1
+
+# Milliseconds catalog changes are collected before being broadcast
+COALESCE_DELAY = 200
+
+# Unannounced changes that force a broadcast without waiting, kept well
+# below Catalog.LOG_SIZE so a delta can always be built
+COALESCE_MAX = 500
+
+# Control protocols, newest first.  Typed sends file records as D-Bus
+# structs, json sends the same catalog as JSON strings and legacy is the
+# original announceJoin/FileList exchange.
+PROTOCOL_TYPED = 'typed'
+PROTOCOL_JSON = 'json'
+PROTOCOL_LEGACY = 'legacy'
+PROTOCOLS = [PROTOCOL_TYPED, PROTOCOL_JSON, PROTOCOL_LEGACY]
+
+# D-Bus struct of a FileInfo.share_dump(): id, title, desc, tags, size
+RECORD_SIGNATURE = '(sssst)'
+
+def from_records(records):
+    """Converts received D-Bus structs back into share_dump lists"""
+    return [[unicode(r[0]), unicode(r[1]), unicode(r[2]), unicode(r[3]), int(r[4])]
+            for r in records]
+
 class TubeSpeak(ExportedGObject):
-    def __init__(self, tube, is_initiator, text_received_cb, get_fileList):
+    """
+    Control tube between the initiator and the peers that joined.
+
+    Peers send announceSyncTyped (or announceSync for JSON) with the
+    catalog id and version they last saw and get back either the changes
+    since then or a full snapshot.  Later changes are broadcast with
+    CatalogChangeTyped or CatalogChange.  A peer whose initiator does not
+    answer falls back to the next older protocol, down to announceJoin,
+    FileList, FileAdd and FileRem.
+    """
+    def __init__(self, tube, is_initiator, text_received_cb, get_fileList, catalog):
         super(TubeSpeak, self).__init__(tube, PATH)
         self._logger = logging.getLogger('fileshare-activity.TubeSpeak')
         self.tube = tube
@@ -32,6 +74,18 @@ class TubeSpeak(ExportedGObject):
         self.entered = False  # Have we set up the tube?
         self.getFileList = get_fileList
         self.still_serving = True
+        self.catalog = catalog
+
+        # Initiator: last version announced and the protocol of each peer
+        self._announced = catalog.version
+        self._peers = {}
+        self._announce_source = None
+
+        # Peer: protocol being tried and whether the initiator answered it
+        self.protocol = PROTOCOLS[0]
+        self.versioned = False
+        self._resyncing = False
+
         self.tube.watch_participants(self.participant_change_cb)
 
     def switch_to_server_mode(self):
@@ -45,14 +99,109 @@ class TubeSpeak(ExportedGObject):
             else:
                 self._logger.debug('Requesting file data')
                 self.add_file_change_handler()
-                self.announceJoin()
+                self.request_sync()
+                gobject.timeout_add(SYNC_TIMEOUT * 1000, self._sync_timeout_cb)
         self.entered = True
 
+        for handle, bus_name in removed:
+            if self._peers.has_key(bus_name):
+                del self._peers[bus_name]
+
+    def request_sync(self):
+        self._resyncing = True
+        if self.protocol == PROTOCOL_TYPED:
+            self.announceSyncTyped(self.catalog.catalog_id, self.catalog.version)
+        else:
+            self.announceSync(self.catalog.catalog_id, self.catalog.version)
+
+    def _sync_timeout_cb(self):
+        if self.versioned:
+            return False
+
+        self.protocol = PROTOCOLS[PROTOCOLS.index(self.protocol) + 1]
+        self._logger.debug('No catalog sync reply, trying %s protocol', self.protocol)
+        if self.protocol == PROTOCOL_LEGACY:
+            self.announceJoin()
+            return False
+
+        self.request_sync()
+        gobject.timeout_add(FALLBACK_TIMEOUT * 1000, self._sync_timeout_cb)
+        return False
+
+    def _peers_using(self, protocol):
+        return protocol in self._peers.values()
+
+    def queue_changes(self):
+        """Schedules announce_changes so changes made meanwhile go together"""
+        if not self.is_initiator or not self.still_serving:
+            return
+
+        if self.catalog.version - self._announced >= COALESCE_MAX:
+            self.announce_changes()
+        elif self._announce_source is None:
+            self._announce_source = gobject.timeout_add(COALESCE_DELAY,
+                                                        self._announce_timeout_cb)
+
+    def _announce_timeout_cb(self):
+        self._announce_source = None
+        self.announce_changes()
+        return False
+
+    def announce_changes(self):
+        """Broadcasts every catalog change made since the last call"""
+        if not self.is_initiator or not self.still_serving:
+            return
+
+        old = self._announced
+        new = self.catalog.version
+        if old == new:
+            return
+        self._announced = new
+
+        catalog_id = self.catalog.catalog_id
+        delta = self.catalog.delta_since(old)
+        if delta is None:
+            # Log was truncated, an unusable change makes peers resync
+            if self._peers_using(PROTOCOL_TYPED):
+                self.CatalogChangeTyped(catalog_id, new, new, [], [])
+            if self._peers_using(PROTOCOL_JSON):
+                self.CatalogChange(catalog_id, old, new, '')
+            return
+
+        added, removed = delta
+        if self._peers_using(PROTOCOL_TYPED):
+            self.CatalogChangeTyped(catalog_id, old, new,
+                                    self.catalog.records(added), removed)
+        if self._peers_using(PROTOCOL_JSON):
+            self.CatalogChange(catalog_id, old, new,
+                               self.catalog.encode_delta(added, removed))
+        if self._peers_using(PROTOCOL_LEGACY):
+            for key in added:
+                self.FileAdd(self.catalog.encode_entry(key))
+            for key in removed:
+                self.FileRem(simplejson.dumps(key))
+
     #Signals
     @signal(dbus_interface=IFACE, signature='')
     def announceJoin(self):
         self._logger.debug('Announced join.')
 
+    @signal(dbus_interface=IFACE, signature='st')
+    def announceSync(self, catalog_id, version):
+        self._logger.debug('Announced sync from %s version %d.', catalog_id, version)
+
+    @signal(dbus_interface=IFACE, signature='st')
+    def announceSyncTyped(self, catalog_id, version):
+        self._logger.debug('Announced typed sync from %s version %d.', catalog_id, version)
+
+    @signal(dbus_interface=IFACE, signature='stts')
+    def CatalogChange(self, catalog_id, from_version, to_version, delta):
+        self._logger.debug('Announced catalog change %d -> %d.', from_version, to_version)
+
+    @signal(dbus_interface=IFACE, signature='stta%sas' % RECORD_SIGNATURE)
+    def CatalogChangeTyped(self, catalog_id, from_version, to_version, added, removed):
+        self._logger.debug('Announced typed catalog change %d -> %d.', from_version, to_version)
+
     @signal(dbus_interface=IFACE, signature='s')
     def FileAdd(self, addFile):
         self._logger.debug('Announced addFile.')
@@ -68,14 +217,56 @@ class TubeSpeak(ExportedGObject):
     def FileList(self, fileList):
         """To be called on the incoming XO after they Hello."""
         self._logger.debug('Somebody called FileList and sent me %s', fileList)
+        if not self._accept_sync(PROTOCOL_LEGACY):
+            return
         self.text_received_cb('filelist',fileList)
 
+    @method(dbus_interface=IFACE, in_signature='stss', out_signature='')
+    def CatalogSync(self, catalog_id, version, kind, data):
+        """Reply to announceSync, kind is either snapshot or delta."""
+        self._logger.debug('Catalog %s sync to version %d (%s)', catalog_id, version, kind)
+        if not self._accept_sync(PROTOCOL_JSON):
+            return
+        self.text_received_cb('catalog_%s' % kind, data)
+        self._synced(PROTOCOL_JSON, catalog_id, version)
+
+    @method(dbus_interface=IFACE, in_signature='stsa%sas' % RECORD_SIGNATURE,
+            out_signature='')
+    def CatalogSyncTyped(self, catalog_id, version, kind, added, removed):
+        """Reply to announceSyncTyped, kind is either snapshot or delta."""
+        self._logger.debug('Catalog %s typed sync to version %d (%s)', catalog_id, version, kind)
+        if not self._accept_sync(PROTOCOL_TYPED):
+            return
+        self.text_received_cb('catalog_%s_records' % kind, (from_records(added), list(removed)))
+        self._synced(PROTOCOL_TYPED, catalog_id, version)
+
+    def _accept_sync(self, protocol):
+        """
+        Checks a sync reply may be applied.  A late reply in a newer protocol
+        than the one in use is followed, since the initiator never moves a
+        peer back to an older protocol.  Replies in an older one are stale.
+        """
+        if PROTOCOLS.index(protocol) > PROTOCOLS.index(self.protocol):
+            self._logger.debug('Ignoring %s sync reply, using %s', protocol, self.protocol)
+            return False
+        return True
+
+    def _synced(self, protocol, catalog_id, version):
+        self.catalog.sync_to(catalog_id, version)
+        self.protocol = protocol
+        self.versioned = True
+        self._resyncing = False
+
     # Handelers
     def add_join_handler(self):
         self._logger.debug('Adding join handler.')
         # Watch for announceJoin
         self.tube.add_signal_receiver(self.announceJoin_cb, 'announceJoin', IFACE,
             path=PATH, sender_keyword='sender')
+        self.tube.add_signal_receiver(self.announceSync_cb, 'announceSync', IFACE,
+            path=PATH, sender_keyword='sender')
+        self.tube.add_signal_receiver(self.announceSyncTyped_cb, 'announceSyncTyped', IFACE,
+            path=PATH, sender_keyword='sender')
 
     def add_file_change_handler(self):
         self._logger.debug('Adding file change handlers.')
@@ -86,6 +277,12 @@ class TubeSpeak(ExportedGObject):
         self.tube.add_signal_receiver(self.file_rem_cb, 'FileRem', IFACE,
             path=PATH, sender_keyword='sender')
 
+        self.tube.add_signal_receiver(self.catalog_change_cb, 'CatalogChange', IFACE,
+            path=PATH, sender_keyword='sender')
+
+        self.tube.add_signal_receiver(self.catalog_change_typed_cb, 'CatalogChangeTyped', IFACE,
+            path=PATH, sender_keyword='sender')
+
     # Callbacks
     def announceJoin_cb(self, sender=None):
         """Somebody joined."""
@@ -93,18 +290,121 @@ class TubeSpeak(ExportedGObject):
             # sender is my bus name, so ignore my own signal
             return
         self._logger.debug('Welcoming %s and sending them data', sender)
+        self._reply_sync(sender, PROTOCOL_LEGACY, None, 0)
 
-        self.tube.get_object(sender, PATH).FileList(self.getFileList(), dbus_interface=IFACE)
+    def _sync_delta(self, catalog_id, version):
+        if catalog_id == self.catalog.catalog_id:
+            return self.catalog.delta_since(version)
+        return None
 
-    def file_add_cb(self, addFile, sender=None):
+    def _reply_sync(self, sender, protocol, catalog_id, version):
+        """
+        Answers a sync request.  A peer that already asked in a newer
+        protocol keeps it, its requests in older ones are only fallbacks
+        sent before our earlier reply reached it.
+        """
+        known = self._peers.get(sender)
+        if known is not None and PROTOCOLS.index(known) < PROTOCOLS.index(protocol):
+            protocol = known
+        self._peers[sender] = protocol
+
+        if protocol == PROTOCOL_LEGACY:
+            self.tube.get_object(sender, PATH).FileList(self.getFileList(),
+                                                        dbus_interface=IFACE)
+        elif protocol == PROTOCOL_JSON:
+            self._reply_sync_json(sender, catalog_id, version)
+        else:
+            self._reply_sync_typed(sender, catalog_id, version)
+
+    def announceSync_cb(self, catalog_id, version, sender=None):
+        """Somebody joined or fell behind, send what they are missing."""
+        if sender == self.tube.get_unique_name() or not self.still_serving:
+            # sender is my bus name, so ignore my own signal
+            return
+        self._reply_sync(sender, PROTOCOL_JSON, catalog_id, version)
+
+    def _reply_sync_json(self, sender, catalog_id, version):
+        delta = self._sync_delta(catalog_id, version)
+        if delta is None:
+            self._logger.debug('Sending %s a catalog snapshot', sender)
+            kind = 'snapshot'
+            data = self.getFileList()
+        else:
+            self._logger.debug('Sending %s changes since version %d', sender, version)
+            kind = 'delta'
+            data = self.catalog.encode_delta(*delta)
+
+        self.tube.get_object(sender, PATH).CatalogSync(self.catalog.catalog_id,
+                self.catalog.version, kind, data, dbus_interface=IFACE)
+
+    def announceSyncTyped_cb(self, catalog_id, version, sender=None):
+        """Same as announceSync_cb but replying with D-Bus structs."""
+        if sender == self.tube.get_unique_name() or not self.still_serving:
+            # sender is my bus name, so ignore my own signal
+            return
+        self._reply_sync(sender, PROTOCOL_TYPED, catalog_id, version)
+
+    def _reply_sync_typed(self, sender, catalog_id, version):
+        delta = self._sync_delta(catalog_id, version)
+        if delta is None:
+            self._logger.debug('Sending %s a typed catalog snapshot', sender)
+            kind = 'snapshot'
+            added = self.catalog.snapshot_records()
+            removed = []
+        else:
+            self._logger.debug('Sending %s typed changes since version %d', sender, version)
+            kind = 'delta'
+            added = self.catalog.records(delta[0])
+            removed = delta[1]
+
+        self.tube.get_object(sender, PATH).CatalogSyncTyped(self.catalog.catalog_id,
+                self.catalog.version, kind, added, removed, dbus_interface=IFACE)
+
+    def _accept_change(self, protocol, catalog_id, from_version, to_version, usable):
+        """Checks a broadcast change applies to us, resyncing on a gap"""
+        if not self.versioned or self.protocol != protocol:
+            return False
+
+        if catalog_id != self.catalog.catalog_id or to_version <= self.catalog.version:
+            # Not the catalog we follow or already applied
+            return False
+
+        # A delta holds the final state of every id it names, so one that
+        # starts before our version can still be applied
+        if not usable or from_version > self.catalog.version:
+            # Missed changes, ask for them unless already waiting
+            if not self._resyncing:
+                self._logger.debug('Catalog gap at version %d, resyncing', self.catalog.version)
+                self.request_sync()
+            return False
+        return True
+
+    def catalog_change_cb(self, catalog_id, from_version, to_version, delta, sender=None):
+        if sender == self.tube.get_unique_name():
+            return
+        if self._accept_change(PROTOCOL_JSON, catalog_id, from_version, to_version, delta):
+            self._logger.debug('Catalog Change Noticed')
+            self.text_received_cb('catalog_delta', delta)
+            self.catalog.sync_to(catalog_id, to_version)
+
+    def catalog_change_typed_cb(self, catalog_id, from_version, to_version, added, removed,
+                                sender=None):
         if sender == self.tube.get_unique_name():
+            return
+        if self._accept_change(PROTOCOL_TYPED, catalog_id, from_version, to_version, True):
+            self._logger.debug('Typed Catalog Change Noticed')
+            self.text_received_cb('catalog_delta_records', (from_records(added), list(removed)))
+            self.catalog.sync_to(catalog_id, to_version)
+
+    def file_add_cb(self, addFile, sender=None):
+        if sender == self.tube.get_unique_name() or self.protocol != PROTOCOL_LEGACY:
             # sender is my bus name, so ignore my own signal
             return
         self._logger.debug('File Add Noticed')
         self.text_received_cb('fileadd',addFile)
 
     def file_rem_cb(self, remFile, sender=None):
-        if sender == self.tube.get_unique_name():
+        if sender == self.tube.get_unique_name() or self.protocol != PROTOCOL_LEGACY:
             # sender is my bus name, so ignore my own signal
             return
         self._logger.debug('File Rem Noticed')
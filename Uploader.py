@@ -0,0 +1,128 @@
+# Copyright (C) 2009, Justin Lewis  (jtl1728@rit.edu)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import Queue
+import threading
+import gobject
+
+import logging
+_logger = logging.getLogger('fileshare-activity.Uploader')
+
+# Objects packaged at the same time
+PACK_WORKERS = 2
+
+# Bundles sent to the server at the same time
+UPLOAD_WORKERS = 2
+
+class BatchUploader(object):
+    """
+    Packages a batch of journal objects on a pool of worker threads and
+    uploads the bundles over a bounded number of parallel connections.
+
+    build_cb(jobject) returns the FileInfo of the packaged object and
+    upload_cb(file_info) sends it, either raises to fail that item alone.
+    status_cb(event, jobject, file_info, error) is called in the main loop
+    with 'packaged', 'uploaded' or 'failed' for each item (file_info is
+    None if packaging failed) and finally 'done' with both set to None.
+    """
+    def __init__(self, build_cb, upload_cb, status_cb,
+                 pack_workers=PACK_WORKERS, upload_workers=UPLOAD_WORKERS):
+        self._build_cb = build_cb
+        self._upload_cb = upload_cb
+        self._status_cb = status_cb
+        self._pack_workers = pack_workers
+        self._upload_workers = upload_workers
+
+        self._pack_queue = Queue.Queue()
+        self._upload_queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._packers = 0
+        self._uploaders = 0
+
+    def start(self, jobjects):
+        if not jobjects:
+            self._report('done', None, None)
+            return
+
+        for jobject in jobjects:
+            self._pack_queue.put(jobject)
+
+        self._packers = min(self._pack_workers, len(jobjects))
+        self._uploaders = min(self._upload_workers, len(jobjects))
+        for i in range(self._packers):
+            self._spawn(self._pack_worker)
+        for i in range(self._uploaders):
+            self._spawn(self._upload_worker)
+
+    def _spawn(self, target):
+        thread = threading.Thread(target=target)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _report(self, event, jobject, file_info, error=None):
+        gobject.idle_add(self._status_cb, event, jobject, file_info, error)
+
+    def _pack_worker(self):
+        while True:
+            try:
+                jobject = self._pack_queue.get_nowait()
+            except Queue.Empty:
+                break
+
+            try:
+                file_info = self._build_cb(jobject)
+            except Exception, e:
+                _logger.debug("Packaging failed: %s", e)
+                self._report('failed', jobject, None, e)
+                continue
+
+            self._report('packaged', jobject, file_info)
+            self._upload_queue.put((jobject, file_info))
+
+        # Last packer out tells the uploaders nothing more is coming
+        self._lock.acquire()
+        try:
+            self._packers -= 1
+            last = self._packers == 0
+        finally:
+            self._lock.release()
+        if last:
+            for i in range(self._uploaders):
+                self._upload_queue.put(None)
+
+    def _upload_worker(self):
+        while True:
+            item = self._upload_queue.get()
+            if item is None:
+                break
+
+            jobject, file_info = item
+            try:
+                self._upload_cb(file_info)
+            except Exception, e:
+                _logger.debug("Upload of %s failed: %s", file_info.id, e)
+                self._report('failed', jobject, file_info, e)
+            else:
+                self._report('uploaded', jobject, file_info)
+
+        self._lock.acquire()
+        try:
+            self._uploaders -= 1
+            last = self._uploaders == 0
+        finally:
+            self._lock.release()
+        if last:
+            self._report('done', None, None)
@@ -18,6 +18,9 @@
 """Sugar bundle file handler"""
 
 import os
+import mmap
+import zlib
+import struct
 import StringIO
 import zipfile
 
@@ -28,6 +31,181 @@ class ZipExtractException(Exception): pass
 class RegistrationException(Exception): pass
 class MalformedBundleException(Exception): pass
 
+# Payload compression modes
+COMPRESS_AUTO = 'auto'
+COMPRESS_ALWAYS = 'always'
+COMPRESS_NEVER = 'never'
+
+class CompressionPolicy:
+    """Decides how a file should be stored inside a bundle.
+
+    In auto mode a few blocks of the file are deflated at the fastest zlib
+    level.  If they don't shrink by at least min_savings the data is
+    considered already compressed (JPEG, OGG, PDF, .xo ...) and is stored
+    as is instead of spending CPU deflating it.
+    """
+    def __init__(self, mode=COMPRESS_AUTO, sample_size=64*1024,
+                 min_savings=0.1):
+        self.mode = mode
+        self.sample_size = sample_size
+        self.min_savings = min_savings
+
+    def _sample(self, path):
+        size = os.path.getsize(path)
+        fd = open(path, 'rb')
+        try:
+            if size <= self.sample_size:
+                return fd.read()
+
+            # Take blocks from the start, middle and end of the file
+            block = self.sample_size / 3
+            data = fd.read(block)
+            fd.seek(size / 2)
+            data += fd.read(block)
+            fd.seek(size - block)
+            data += fd.read(block)
+            return data
+        finally:
+            fd.close()
+
+    def is_compressible(self, path):
+        data = self._sample(path)
+        if not data:
+            return False
+        compressed = len(zlib.compress(data, 1))
+        return compressed <= len(data) * (1.0 - self.min_savings)
+
+    def compress_type(self, path):
+        """Returns the zipfile compression constant to use for path"""
+        if self.mode == COMPRESS_NEVER:
+            return zipfile.ZIP_STORED
+        if self.mode == COMPRESS_ALWAYS or self.is_compressible(path):
+            return zipfile.ZIP_DEFLATED
+        return zipfile.ZIP_STORED
+
+DEFAULT_POLICY = CompressionPolicy()
+
+# Buffer size used when streaming entries out of a bundle
+EXTRACT_BUFFER_SIZE = 64 * 1024
+
+# Local file header: signature, versions, flags, method, time, date, crc,
+# sizes, then the file name and extra field lengths
+_LOCAL_HEADER = '<4s2B4HL2L2H'
+_LOCAL_HEADER_SIZE = struct.calcsize(_LOCAL_HEADER)
+
+class ZipIndex:
+    """Read only view of a zip file that parses its central directory once.
+
+    Offsets of entry data are cached after the first lookup and entries are
+    read straight out of an mmap of the file when it can be mapped, so
+    repeated reads of the same bundle don't reopen or reparse it.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._stamp = self._get_stamp()
+
+        zip_file = zipfile.ZipFile(path, 'r')
+        try:
+            infolist = zip_file.infolist()
+        finally:
+            zip_file.close()
+
+        self._names = [info.filename for info in infolist]
+        self._entries = dict([(info.filename, info) for info in infolist])
+        self._offsets = {}
+
+        self._fd = open(path, 'rb')
+        self._map = None
+        try:
+            if self._stamp[0] > 0:
+                self._map = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, mmap.error):
+            # Fall back to plain reads
+            self._map = None
+
+    def _get_stamp(self):
+        st = os.stat(self._path)
+        return st.st_size, st.st_mtime
+
+    def is_current(self):
+        """Returns False if the file changed since it was indexed"""
+        try:
+            return self._get_stamp() == self._stamp
+        except OSError:
+            return False
+
+    def namelist(self):
+        return list(self._names)
+
+    def getinfo(self, name):
+        return self._entries[name]
+
+    def _read_at(self, offset, size):
+        if self._map is not None:
+            return self._map[offset:offset + size]
+        self._fd.seek(offset)
+        return self._fd.read(size)
+
+    def _data_offset(self, info):
+        offset = self._offsets.get(info.filename)
+        if offset is None:
+            header = self._read_at(info.header_offset, _LOCAL_HEADER_SIZE)
+            if len(header) != _LOCAL_HEADER_SIZE:
+                raise zipfile.BadZipfile('Truncated header for %s' % info.filename)
+            fields = struct.unpack(_LOCAL_HEADER, header)
+            if fields[0] != 'PK\003\004':
+                raise zipfile.BadZipfile('Bad local header for %s' % info.filename)
+            offset = info.header_offset + _LOCAL_HEADER_SIZE + fields[10] + fields[11]
+            self._offsets[info.filename] = offset
+        return offset
+
+    def _chunks(self, info, buffer_size):
+        """Yields the uncompressed data of an entry, buffer_size at a time"""
+        if info.flag_bits & 0x1:
+            raise zipfile.BadZipfile('Encrypted entry %s' % info.filename)
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-15)
+        elif info.compress_type != zipfile.ZIP_STORED:
+            raise zipfile.BadZipfile('Unsupported compression for %s' % info.filename)
+
+        offset = self._data_offset(info)
+        remaining = info.compress_size
+        crc = 0
+        while remaining > 0:
+            data = self._read_at(offset, min(buffer_size, remaining))
+            if not data:
+                raise zipfile.BadZipfile('Truncated data for %s' % info.filename)
+            offset += len(data)
+            remaining -= len(data)
+
+            if info.compress_type == zipfile.ZIP_DEFLATED:
+                data = decompressor.decompress(data)
+                if remaining == 0:
+                    data += decompressor.flush()
+            crc = zlib.crc32(data, crc)
+            yield data
+
+        if crc & 0xffffffff != info.CRC & 0xffffffff:
+            raise zipfile.BadZipfile('Bad CRC for %s' % info.filename)
+
+    def read(self, name):
+        """Returns the uncompressed data of an entry, KeyError if missing"""
+        info = self._entries[name]
+        return ''.join(self._chunks(info, max(info.compress_size, 1)))
+
+    def copy_to(self, name, fileobj, buffer_size=EXTRACT_BUFFER_SIZE):
+        """Streams an entry into fileobj without holding it in memory"""
+        for data in self._chunks(self._entries[name], buffer_size):
+            fileobj.write(data)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+
 class Bundle:
     """A Sugar activity, content module, etc.
     
@@ -39,6 +217,7 @@ class Bundle:
     """
     def __init__(self, path):
         self._path = path
+        self._index = None
         
         if not os.path.exists(self._path):
             z = zipfile.ZipFile(self._path, 'w')
@@ -53,12 +232,30 @@ class Bundle:
         # if signature is None:
         #     raise MalformedBundleException('No signature file')
 
+    def _get_index(self):
+        """Returns the cached index of the bundle, rebuilt if it changed"""
+        if self._index is not None and not self._index.is_current():
+            self._close_index()
+
+        if self._index is None:
+            try:
+                self._index = ZipIndex(self._path)
+            except (EnvironmentError, zipfile.BadZipfile):
+                raise MalformedBundleException
+
+        return self._index
+
+    def _close_index(self):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def close(self):
+        """Releases the open bundle file, it is reopened on next use"""
+        self._close_index()
+
     def _check_zip_bundle(self):
-        try:
-            zip_file = zipfile.ZipFile(self._path,'r')
-            file_names = zip_file.namelist()
-        except:
-            raise MalformedBundleException
+        file_names = self._get_index().namelist()
         
         if len(file_names) == 0:
             raise MalformedBundleException('Empty zip file')
@@ -84,15 +281,13 @@ class Bundle:
     def _get_file(self, filename):
         file = None
 
-        zip_file = zipfile.ZipFile(self._path)
         path = os.path.join(self._zip_root_dir, filename)
         try:
-            data = zip_file.read(path)
+            data = self._get_index().read(path)
             file = StringIO.StringIO(data)
         except KeyError:
             # == "file not found"
             pass
-        zip_file.close()
 
         return file
 
@@ -100,19 +295,46 @@ class Bundle:
         """Get the bundle path."""
         return self._path
 
+    def _extract_member(self, index, name, target_path):
+        """Streams one entry of the bundle index to target_path"""
+        target_dir = os.path.dirname(target_path)
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir, 0775)
+
+        try:
+            dst = open(target_path, 'wb')
+            try:
+                index.copy_to(name, dst, EXTRACT_BUFFER_SIZE)
+            finally:
+                dst.close()
+        except (KeyError, zipfile.BadZipfile, zlib.error), e:
+            raise ZipExtractException(str(e))
+
     def _unzip(self, install_dir):
         if not os.path.isdir(install_dir):
             os.mkdir(install_dir, 0775)
 
-        # zipfile provides API that in theory would let us do this
-        # correctly by hand, but handling all the oddities of
-        # Windows/UNIX mappings, extension attributes, deprecated
-        # features, etc makes it impractical.
         # FIXME: use manifest
-        if os.spawnlp(os.P_WAIT, 'unzip', 'unzip', '-o', self._path,
-                      '-x', 'mimetype', '-d', install_dir):
+        try:
+            index = self._get_index()
+        except MalformedBundleException:
             raise ZipExtractException
 
+        root = os.path.abspath(install_dir)
+        for name in index.namelist():
+            if name == 'mimetype':
+                continue
+
+            target_path = os.path.abspath(os.path.join(root, name))
+            if not target_path.startswith(root + os.sep):
+                raise ZipExtractException('Entry outside of the bundle: %s' % name)
+
+            if name.endswith('/'):
+                if not os.path.isdir(target_path):
+                    os.makedirs(target_path, 0775)
+            else:
+                self._extract_member(index, name, target_path)
+
     def _add_files(self, files_path):
         # FIXME: maintain manifest
         try:
@@ -126,8 +348,7 @@ class Bundle:
         zip.close()
     
     def _get_ziproot(self):
-        zip_file = zipfile.ZipFile(self._path,'r')
-        file_names = zip_file.namelist()
+        file_names = self._get_index().namelist()
         if len(file_names) == 0:
             raise MalformedBundleException('Empty zip file')
 
@@ -15,11 +15,15 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import time
+import zlib
+import struct
 import tempfile
 import logging
 import shutil
 import zipfile
 import stat
+import hashlib
 
 import simplejson as json
 
@@ -29,11 +33,17 @@ from sugar.datastore import datastore
 #    NotInstalledException, InvalidPathException
 
 from bundle import Bundle, MalformedBundleException, \
-    NotInstalledException, InvalidPathException
+    NotInstalledException, InvalidPathException, DEFAULT_POLICY, \
+    EXTRACT_BUFFER_SIZE
+import ContentHash
 
 RWXR_XR_X = stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH
 RW_R__R__ = stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH
 
+# Date given to the entries of assembled bundles, so the same entry always
+# turns into the same bytes
+STORED_DATE = (1980, 1, 1, 0, 0, 0)
+
 # FIXME: We should not be doing this for every entry. Cannot get JSON to accept
 # the dbus types?
 def _sanitize_dbus_dict(dbus_dict):
@@ -44,12 +54,138 @@ def _sanitize_dbus_dict(dbus_dict):
         base_dict[k] = v
     return base_dict
 
-def from_jobject(jobject, bundle_path):
-    b = JournalEntryBundle(bundle_path)
-    b.set_metadata(jobject.get_metadata())
-    if jobject.get_file_path():
-        b.set_file(jobject.get_file_path())
-    return b
+def metadata_hash(metadata):
+    """Returns a digest identifying the contents of a metadata dict"""
+    metadata = _sanitize_dbus_dict(metadata)
+
+    # Preview is raw PNG data that JSON can't encode, hash its bytes apart
+    preview = metadata.pop('preview', '')
+    digest = hashlib.sha1(json.dumps(metadata, sort_keys=True))
+    digest.update(hashlib.sha1(preview).digest())
+    return digest.hexdigest()
+
+def _make_entry_id(metadata):
+    entry_id = metadata.get('activity_id', '')
+    if( entry_id == "" ):
+        #If the entry_id is empty, (file not activity) then make an entryid
+        if metadata.has_key('timestamp'):
+            entry_id = hashlib.sha1(metadata['timestamp']).hexdigest()
+        else:
+            import time
+            entry_id = hashlib.sha1( str(time.time()) ).hexdigest()
+    return entry_id
+
+def split_metadata(metadata):
+    """
+    Returns the entry id, encoded _metadata.json and preview (None if there
+    is none) a bundle stores for the metadata of a journal object.
+    """
+    metadata = _sanitize_dbus_dict(metadata)
+    entry_id = _make_entry_id(metadata)
+    preview = None
+    if 'preview' in metadata:
+        preview = metadata['preview']
+        metadata['preview'] = entry_id
+    return entry_id, json.dumps(metadata), preview
+
+def _install_entry(uid, metadata, preview, put_file=None):
+    """
+    Writes an entry to the datastore.  put_file(path), if given, places
+    the payload at path first.
+    """
+    if os.environ.has_key('SUGAR_ACTIVITY_ROOT'):
+        install_dir = os.path.join(os.environ['SUGAR_ACTIVITY_ROOT'], 'instance')
+    else:
+        install_dir = tempfile.gettempdir()
+
+    if uid in ('', '.', '..'):
+        raise MalformedBundleException('Invalid entry id %r' % uid)
+
+    bundle_dir = os.path.join(install_dir, uid)
+    payload_path = None
+    try:
+        if put_file:
+            if not os.path.isdir(bundle_dir):
+                os.makedirs(bundle_dir, 0775)
+            payload_path = os.path.join(bundle_dir, uid)
+            put_file(payload_path)
+
+        jobject = datastore.create()
+        try:
+            for key, value in metadata.iteritems():
+                jobject.metadata[key] = value
+
+            if preview != '':
+                jobject.metadata['preview'] = dbus.ByteArray(preview)
+            jobject.metadata['uid'] = ''
+
+            if jobject.metadata.has_key('mountpoint'):
+                del jobject.metadata['mountpoint']
+
+            if payload_path:
+                os.chmod(bundle_dir, RWXR_XR_X)
+                jobject.file_path = payload_path
+                os.chmod(jobject.file_path, RW_R__R__)
+
+            datastore.write(jobject)
+        finally:
+            jobject.destroy()
+    finally:
+        shutil.rmtree(bundle_dir, ignore_errors=True)
+
+def from_jobject(jobject, bundle_path, policy=DEFAULT_POLICY):
+    metadata = _sanitize_dbus_dict(jobject.get_metadata())
+    writer = JournalEntryBundleWriter(bundle_path, _make_entry_id(metadata),
+                                      policy)
+    try:
+        writer.add_metadata(metadata)
+        if jobject.get_file_path():
+            writer.add_file(jobject.get_file_path())
+        writer.close()
+    except:
+        # Don't leave a half written bundle behind
+        writer.close()
+        os.remove(bundle_path)
+        raise
+    return JournalEntryBundle(bundle_path)
+
+class JournalEntryBundleWriter(object):
+    """Builds a journal entry bundle in one pass over a single open zip file
+
+    Entries are written in the order the reader expects: the entry
+    directory, the preview, _metadata.json and finally the payload.
+    """
+    def __init__(self, path, entry_id, policy=DEFAULT_POLICY):
+        self._entry_id = entry_id
+        self._policy = policy
+        self._zip_file = zipfile.ZipFile(path, 'w')
+        self._zip_file.writestr(zipfile.ZipInfo(entry_id + '/'), '')
+
+    def get_entry_id(self):
+        return self._entry_id
+
+    def add_preview(self, preview_data):
+        preview_path = os.path.join(self._entry_id, 'preview', self._entry_id)
+        self._zip_file.writestr(preview_path, preview_data)
+
+    def add_metadata(self, metadata):
+        metadata = dict(metadata)
+        if 'preview' in metadata:
+            self.add_preview(str(metadata['preview']))
+            metadata['preview'] = self._entry_id
+
+        info = zipfile.ZipInfo(os.path.join(self._entry_id, "_metadata.json"))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        self._zip_file.writestr(info, json.dumps(metadata))
+
+    def add_file(self, infile):
+        file_path = os.path.join(self._entry_id, self._entry_id)
+        self._zip_file.write(infile, file_path, self._policy.compress_type(infile))
+
+    def close(self):
+        if self._zip_file:
+            self._zip_file.close()
+            self._zip_file = None
 
 class JournalEntryBundle(Bundle):
     """A Journal entry bundle
@@ -66,12 +202,8 @@ class JournalEntryBundle(Bundle):
     def __init__(self, path):
         Bundle.__init__(self, path)
 
-    def get_entry_id(self):
-        try:
-            zip_file = zipfile.ZipFile(self._path,'r')
-            file_names = zip_file.namelist()
-        except:
-            raise MalformedBundleException
+    def _read_entry_id(self, index):
+        file_names = index.namelist()
         if len(file_names) == 0:
             raise MalformedBundleException('Empty zip file')
 
@@ -81,7 +213,11 @@ class JournalEntryBundle(Bundle):
         zip_root_dir = file_names[0].split('/')[0]
         return zip_root_dir
 
+    def get_entry_id(self):
+        return self._read_entry_id(self._get_index())
+
     def set_entry_id(self, entry_id):
+        self._close_index()
         try:
             zip_file = zipfile.ZipFile(self._path,'a')
         except:
@@ -90,61 +226,67 @@ class JournalEntryBundle(Bundle):
         if len(file_names) == 0:
             base_dir = zipfile.ZipInfo(entry_id + '/')
             zip_file.writestr(base_dir, '')
+            zip_file.close()
         else:
+            zip_file.close()
             raise MalformedBundleException("entry_id already set")
 
     def install(self):
-        if os.environ.has_key('SUGAR_ACTIVITY_ROOT'):
-            install_dir = os.path.join(os.environ['SUGAR_ACTIVITY_ROOT'], 'instance')
-        else:
-            install_dir = tempfile.gettempdir()
-        uid = self.get_entry_id()
-        bundle_dir = os.path.join(install_dir, uid)
-        self._unzip(install_dir)
+        # Read everything needed from the bundle index and only copy the
+        # payload out, metadata and preview are kept in memory
+        index = self._get_index()
+        uid = self._read_entry_id(index)
+        metadata = self._read_metadata(index, uid)
+        preview = self._read_preview(index, uid)
+
+        put_file = None
+        if os.path.join(uid, uid) in index.namelist():
+            put_file = lambda path: self._extract_member(index, os.path.join(uid, uid), path)
+        _install_entry(uid, metadata, preview, put_file)
+
+    def read_entry(self):
+        """Returns the entry id, encoded _metadata.json and preview or None"""
+        index = self._get_index()
+        entry_id = self._read_entry_id(index)
         try:
-            metadata = self.get_metadata()
-            jobject = datastore.create()
-            try:
-                for key, value in metadata.iteritems():
-                    jobject.metadata[key] = value
-
-                preview = self.get_preview()
-                if preview != '':
-                    jobject.metadata['preview'] = dbus.ByteArray(preview)
-                jobject.metadata['uid'] = ''
-
-                if jobject.metadata.has_key('mountpoint'):
-                    del jobject.metadata['mountpoint']
-
-                os.chmod(bundle_dir, RWXR_XR_X)
-
-                if( os.path.exists( os.path.join(bundle_dir, uid) ) ):
-                    jobject.file_path = os.path.join(bundle_dir, uid)
-                    os.chmod(jobject.file_path, RW_R__R__)
+            metadata = index.read(os.path.join(entry_id, "_metadata.json"))
+        except KeyError:
+            raise MalformedBundleException('Bundle must contain the file "_metadata.json".')
 
-                datastore.write(jobject)
-            finally:
-                jobject.destroy()
-        finally:
-            shutil.rmtree(bundle_dir, ignore_errors=True)
+        preview = None
+        preview_path = os.path.join(entry_id, 'preview', entry_id)
+        if preview_path in index.namelist():
+            preview = index.read(preview_path)
+        return entry_id, metadata, preview
+
+    def extract_file(self, target_path):
+        """Streams the payload to target_path, returns False if there is none"""
+        index = self._get_index()
+        entry_id = self._read_entry_id(index)
+        name = os.path.join(entry_id, entry_id)
+        if name not in index.namelist():
+            return False
+        self._extract_member(index, name, target_path)
+        return True
 
     def set_preview(self, preview_data):
         entry_id = self.get_entry_id()
         preview_path = os.path.join(entry_id, 'preview', entry_id)
+        self._close_index()
         zip_file = zipfile.ZipFile(self._path,'a')
         zip_file.writestr(preview_path, preview_data)
         zip_file.close()
 
-    def get_preview(self):
-        entry_id = self.get_entry_id()
+    def _read_preview(self, index, entry_id):
         preview_path = os.path.join(entry_id, 'preview', entry_id)
-        zip_file = zipfile.ZipFile(self._path,'r')
         try:
-            preview_data = zip_file.read(preview_path)
+            return index.read(preview_path)
         except:
-            preview_data = ''
-        zip_file.close()
-        return preview_data
+            return ''
+
+    def get_preview(self):
+        index = self._get_index()
+        return self._read_preview(index, self._read_entry_id(index))
 
     def is_installed(self):
         # These bundles can be reinstalled as many times as desired.
@@ -157,16 +299,7 @@ class JournalEntryBundle(Bundle):
             #if entry_id != metadata[uid]:
             #    raise InvalidPathException("metadata's entry id is different from my entry id")
         except MalformedBundleException:
-            entry_id = metadata['activity_id']
-            if( entry_id == "" ):
-                #If the entry_id is empty, (file not activity) then make an entryid
-                import hashlib
-
-                if metadata.has_key('timestamp'):
-                    entry_id = hashlib.sha1(metadata['timestamp']).hexdigest()
-                else:
-                    import time
-                    entry_id = hashlib.sha1( str(time.time()) ).hexdigest()
+            entry_id = _make_entry_id(metadata)
             self.set_entry_id(entry_id)
 
         if 'preview' in metadata:
@@ -175,36 +308,223 @@ class JournalEntryBundle(Bundle):
 
         encoded_metadata = json.dumps(metadata)
 
+        self._close_index()
         zip_file = zipfile.ZipFile(self._path,'a')
         zip_file.writestr(os.path.join(entry_id, "_metadata.json"), encoded_metadata)
         zip_file.close()
 
-    def get_metadata(self):
-        entry_id = self.get_entry_id()
-        zip_file = zipfile.ZipFile(self._path,'r')
+    def _read_metadata(self, index, entry_id):
         metadata_path = os.path.join(entry_id,"_metadata.json")
         try:
-            encoded_data = zip_file.read(metadata_path)
+            encoded_data = index.read(metadata_path)
         except:
             raise MalformedBundleException('Bundle must contain the file "_metadata.json".')
-        zip_file.close()
 
         return json.loads(encoded_data)
 
-    def set_file(self, infile):
+    def get_metadata(self):
+        index = self._get_index()
+        return self._read_metadata(index, self._read_entry_id(index))
+
+    def set_file(self, infile, policy=DEFAULT_POLICY):
         entry_id = self.get_entry_id()
         file_path = os.path.join(entry_id, entry_id)
+        self._close_index()
         zip_file = zipfile.ZipFile(self._path, 'a')
-        zip_file.write(infile, file_path)
+        zip_file.write(infile, file_path, policy.compress_type(infile))
         zip_file.close()
 
     def get_file(self):
         entry_id = self.get_entry_id()
         file_path = os.path.join(entry_id, entry_id)
         try:
-            zip_file = zipfile.ZipFile(self._path,'r')
-            file_data = zip_file.read(file_path)
-            zip_file.close()
+            file_data = self._get_index().read(file_path)
         except:
             file_data = ''
         return file_data
+
+class _LayoutFile(object):
+    """Write only file keeping what zipfile writes before and after a gap"""
+    def __init__(self):
+        self.head = []
+        self.tail = []
+        self._out = self.head
+        self._position = 0
+
+    def write(self, data):
+        self._out.append(data)
+        self._position += len(data)
+
+    def skip(self, size):
+        """Leaves size bytes out, anything written afterwards is the tail"""
+        self._out = self.tail
+        self._position += size
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+class StoredBundle(object):
+    """
+    Journal entry bundle assembled from its metadata and a payload file.
+
+    The payload is kept uncompressed, so the bundle is a small header in
+    memory, the payload file as it is and the zip central directory.  It
+    is served, uploaded and saved from those parts and never written out.
+    payload is (path, size, crc, digest) or None for entries without one.
+    """
+    def __init__(self, name, entry_id, metadata, preview=None, payload=None,
+                 mtime=None):
+        self.name = name
+        self.mtime = mtime or time.time()
+        self._entry_id = entry_id
+        self._metadata = metadata
+        self._preview = preview
+        self.payload = payload
+
+        layout = _LayoutFile()
+        zip_file = zipfile.ZipFile(layout, 'w', zipfile.ZIP_STORED, True)
+        zip_file.writestr(self._info(entry_id + '/', 0), '')
+        if preview is not None:
+            zip_file.writestr(self._info(os.path.join(entry_id, 'preview', entry_id)),
+                              preview)
+        info = self._info(os.path.join(entry_id, "_metadata.json"))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        zip_file.writestr(info, metadata)
+
+        if payload:
+            path, size, crc, digest = payload
+            info = self._info(os.path.join(entry_id, entry_id))
+            info.file_size = info.compress_size = size
+            info.CRC = crc
+            info.header_offset = layout.tell()
+            zip_file._writecheck(info)
+            layout.write(info.FileHeader())
+            layout.skip(size)
+            zip_file.filelist.append(info)
+            zip_file.NameToInfo[info.filename] = info
+        zip_file.close()
+
+        self._head = ''.join(layout.head)
+        self._tail = ''.join(layout.tail)
+        self.size = layout.tell()
+
+        digest = hashlib.sha1(self._head)
+        if payload:
+            digest.update(payload[3])
+        digest.update(self._tail)
+        self.etag = '"%s"' % digest.hexdigest()
+
+    def _info(self, name, mode=0600):
+        info = zipfile.ZipInfo(name, STORED_DATE)
+        info.external_attr = mode << 16L
+        return info
+
+    def parts(self):
+        """Returns the bundle as strings and a (path, size) for the payload"""
+        if not self.payload:
+            return [self._head, self._tail]
+        return [self._head, (self.payload[0], self.payload[1]), self._tail]
+
+    def open(self):
+        return StoredBundleFile(self)
+
+    def write_to(self, zip_file, arcname):
+        """Adds the bundle to zip_file as a stored member, streamed"""
+        info = zipfile.ZipInfo(arcname, time.localtime(self.mtime)[:6])
+        info.external_attr = 0600 << 16L
+        info.file_size = info.compress_size = self.size
+        info.CRC = 0
+        info.header_offset = zip_file.fp.tell()
+        zip_file._writecheck(info)
+        zip_file._didModify = True
+        zip_file.fp.write(info.FileHeader())
+
+        crc = 0
+        reader = self.open()
+        try:
+            while True:
+                data = reader.read(EXTRACT_BUFFER_SIZE)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                zip_file.fp.write(data)
+        finally:
+            reader.close()
+
+        # Sizes are known up front, only the crc has to be filled in
+        info.CRC = crc & 0xffffffff
+        position = zip_file.fp.tell()
+        zip_file.fp.seek(info.header_offset + 14, 0)
+        zip_file.fp.write(struct.pack('<L', info.CRC))
+        zip_file.fp.seek(position, 0)
+        zip_file.filelist.append(info)
+        zip_file.NameToInfo[info.filename] = info
+
+    def get_metadata(self):
+        return json.loads(self._metadata)
+
+    def install(self):
+        put_file = None
+        if self.payload:
+            # Blobs are never changed in place, a link is as good as a copy
+            put_file = lambda path: ContentHash.link_or_copy(self.payload[0], path)
+        _install_entry(self._entry_id, self.get_metadata(), self._preview or '',
+                       put_file)
+
+class StoredBundleFile(object):
+    """Read only file over a StoredBundle, name and size as for a bundle file"""
+    def __init__(self, bundle):
+        self.name = bundle.name
+        self.size = bundle.size
+        self._parts = bundle.parts()
+        self._offset = 0
+        self._fd = None
+        for part in self._parts:
+            if isinstance(part, tuple):
+                self._fd = open(part[0], 'rb')
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._offset
+        elif whence == 2:
+            offset += self.size
+        self._offset = max(offset, 0)
+
+    def tell(self):
+        return self._offset
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size
+
+        chunks = []
+        start = 0
+        for part in self._parts:
+            if isinstance(part, tuple):
+                length = part[1]
+            else:
+                length = len(part)
+
+            if size > 0 and start <= self._offset < start + length:
+                skip = self._offset - start
+                count = min(length - skip, size)
+                if isinstance(part, tuple):
+                    self._fd.seek(skip)
+                    data = self._fd.read(count)
+                    if len(data) != count:
+                        raise IOError("%s shrank while being read" % part[0])
+                else:
+                    data = part[skip:skip + count]
+                chunks.append(data)
+                self._offset += count
+                size -= count
+            start += length
+        return ''.join(chunks)
+
+    def close(self):
+        if self._fd:
+            self._fd.close()
+            self._fd = None
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# Copyright (C) 2009, Justin Lewis  (jtl1728@rit.edu)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Usage:
+  python tools/bench_compression.py [file ...]
+
+Compares packaging time and bundle size for the bundle compression modes.
+Without arguments synthetic text, media (random bytes, standing in for
+JPEG/OGG/PDF data) and .xo (zipped text) payloads are generated.
+"""
+
+import os
+import sys
+import time
+import random
+import zipfile
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import bundle
+
+SIZE = 4 * 1024 * 1024
+
+def make_samples(tmp_dir):
+    words = 'the quick brown fox jumps over a lazy dog while children read'.split()
+    text = ' '.join([random.choice(words) for i in xrange(SIZE / 4)])[:SIZE]
+
+    samples = []
+    path = os.path.join(tmp_dir, 'text.txt')
+    open(path, 'wb').write(text)
+    samples.append(path)
+
+    path = os.path.join(tmp_dir, 'media.jpg')
+    open(path, 'wb').write(os.urandom(SIZE))
+    samples.append(path)
+
+    path = os.path.join(tmp_dir, 'activity.xo')
+    z = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    z.writestr('activity/text.txt', text)
+    z.close()
+    samples.append(path)
+
+    return samples
+
+def package(path, policy, out_path):
+    start = time.time()
+    z = zipfile.ZipFile(out_path, 'w')
+    z.write(path, 'entry/entry', policy.compress_type(path))
+    z.close()
+    return time.time() - start, os.path.getsize(out_path)
+
+def main():
+    tmp_dir = tempfile.mkdtemp()
+    out_path = os.path.join(tmp_dir, 'out.xoj')
+    try:
+        samples = sys.argv[1:] or make_samples(tmp_dir)
+        modes = [bundle.COMPRESS_NEVER, bundle.COMPRESS_ALWAYS, bundle.COMPRESS_AUTO]
+
+        print "%-20s %10s %8s %10s %12s" % ('file', 'size', 'mode', 'time (s)', 'bundle size')
+        for path in samples:
+            for mode in modes:
+                elapsed, size = package(path, bundle.CompressionPolicy(mode), out_path)
+                print "%-20s %10d %8s %10.3f %12d" % (os.path.basename(path)[:20],
+                        os.path.getsize(path), mode, elapsed, size)
+    finally:
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+
+if __name__ == "__main__":
+    main()
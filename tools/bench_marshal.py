@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# Copyright (C) 2009, Justin Lewis  (jtl1728@rit.edu)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+"""
+Usage:
+  python tools/bench_marshal.py [entries]
+
+Compares the cost of sending a catalog snapshot of 10000 entries (by
+default) to a joining peer: as a JSON string in a D-Bus 's' argument, and
+as native D-Bus structs.  Each round encodes and decodes the list once, as
+a join does.
+"""
+
+import os
+import sys
+import time
+import simplejson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import TubeSpeak
+
+try:
+    from dbus.lowlevel import SignalMessage
+except ImportError:
+    SignalMessage = None
+
+ENTRIES = 10000
+ROUNDS = 5
+
+def make_records(count):
+    return [('%040x' % i, 'Title %d' % i, 'Description of object %d' % i,
+             'tag%d other' % (i % 50), 1024 * (i % 4096)) for i in xrange(count)]
+
+def marshal(args, signature):
+    msg = SignalMessage(TubeSpeak.PATH, TubeSpeak.IFACE, 'Bench')
+    msg.append(signature=signature, *args)
+    return msg.get_args_list()
+
+def json_join(records):
+    data = simplejson.dumps(dict([(r[0], list(r)) for r in records]))
+    if SignalMessage:
+        data = marshal([data], 's')[0]
+    return simplejson.loads(data).values()
+
+def typed_join(records):
+    received = marshal([records], 'a' + TubeSpeak.RECORD_SIGNATURE)[0]
+    return TubeSpeak.from_records(received)
+
+def bench(name, func, records):
+    best = None
+    for i in xrange(ROUNDS):
+        start = time.time()
+        func(records)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-8s %10d %12.1f" % (name, len(records), best * 1000)
+
+def main():
+    count = ENTRIES
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    records = make_records(count)
+
+    print "%-8s %10s %12s" % ('format', 'entries', 'best (ms)')
+    bench('json', json_join, records)
+    if SignalMessage:
+        bench('typed', typed_join, records)
+    else:
+        print "dbus-python not available, typed marshalling not measured"
+
+if __name__ == "__main__":
+    main()
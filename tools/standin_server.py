@@ -0,0 +1,250 @@
+#!/usr/bin/python
+# Copyright (C) 2009, Justin Lewis  (jtl1728@rit.edu)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+"""
+Usage:
+  python tools/standin_server.py [--port 14623] [--dir path] [--entries n]
+
+Local stand-in for the school server, for testing server mode without one.
+Serves the requests the activity makes (/version, /announce_user,
+/user_list, /user_mod, /upload, /remove and bundle downloads) plus the
+conditional, paged /filelist:
+
+  GET /filelist?offset=N&limit=M
+      Returns a JSON object of up to M entries (id -> share_dump), sorted
+      by id, starting at N.  The ETag covers the whole list and a matching
+      If-None-Match gets 304.  X-FileShare-Next-Offset is set while more
+      entries remain.  Without a limit the whole list is returned.
+
+--entries adds that many synthetic entries (without bundles) so paging can
+be tried against a large catalog.
+"""
+
+import os
+import sys
+import cgi
+import shutil
+import urllib
+import urlparse
+import tempfile
+import threading
+import simplejson
+import BaseHTTPServer
+import SocketServer
+from hashlib import sha1
+
+# Largest page the server hands out whatever the client asks for
+MAX_LIMIT = 1000
+
+class Catalog(object):
+    def __init__(self, storage):
+        self.storage = storage
+        self.files = {}
+        self.users = {}
+        self.lock = threading.Lock()
+        self._etag = None
+
+    def changed(self):
+        self._etag = None
+
+    def etag(self):
+        if self._etag is None:
+            digest = sha1(simplejson.dumps(self.files, sort_keys=True)).hexdigest()
+            self._etag = '"%s"' % digest
+        return self._etag
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        sys.stderr.write("%s\n" % (format % args))
+
+    def _reply(self, status, body='', headers={}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _form(self):
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={'REQUEST_METHOD': 'POST',
+                                         'CONTENT_TYPE': self.headers['Content-Type']})
+        return form
+
+    def do_GET(self):
+        catalog = self.server.catalog
+        path, _, query = self.path.partition('?')
+        if path == '/version':
+            self._reply(200, '2')
+        elif path == '/filelist':
+            self._filelist(catalog, urlparse.parse_qs(query))
+        else:
+            self._bundle(catalog, urllib.unquote(path[1:]))
+
+    def _filelist(self, catalog, query):
+        catalog.lock.acquire()
+        try:
+            etag = catalog.etag()
+            if self.headers.get('If-None-Match') == etag:
+                self._reply(304, headers={'ETag': etag})
+                return
+
+            keys = sorted(catalog.files)
+            offset = int(query.get('offset', ['0'])[0])
+            if query.has_key('limit'):
+                limit = min(int(query['limit'][0]), MAX_LIMIT)
+            else:
+                limit = len(keys)
+            page_keys = keys[offset:offset + limit]
+            page = dict([(key, catalog.files[key]) for key in page_keys])
+        finally:
+            catalog.lock.release()
+
+        headers = {'ETag': etag, 'Content-Type': 'application/json'}
+        if offset + limit < len(keys):
+            headers['X-FileShare-Next-Offset'] = str(offset + limit)
+        self._reply(200, simplejson.dumps(page), headers)
+
+    def _bundle(self, catalog, file_id):
+        path = os.path.join(catalog.storage, '%s.xoj' % os.path.basename(file_id))
+        if not os.path.exists(path):
+            self._reply(404)
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        status = 200
+        ranges = self.headers.get('Range', '')
+        if ranges.startswith('bytes=') and ',' not in ranges:
+            first, _, last = ranges[6:].partition('-')
+            if first:
+                start = int(first)
+                if last:
+                    end = min(int(last), size - 1)
+            elif last:
+                start = max(0, size - int(last))
+            if start > end:
+                self._reply(416, headers={'Content-Range': 'bytes */%d' % size})
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.end_headers()
+
+        fd = open(path, 'rb')
+        try:
+            fd.seek(start)
+            left = end - start + 1
+            while left > 0:
+                data = fd.read(min(left, 64 * 1024))
+                if not data:
+                    break
+                self.wfile.write(data)
+                left -= len(data)
+        finally:
+            fd.close()
+
+    def do_POST(self):
+        catalog = self.server.catalog
+        form = self._form()
+        path = self.path.partition('?')[0]
+
+        catalog.lock.acquire()
+        try:
+            if path == '/announce_user':
+                catalog.users[form.getfirst('id')] = [form.getfirst('nick'), 2]
+                self._reply(200, '2')
+            elif path == '/user_list':
+                self._reply(200, simplejson.dumps(catalog.users))
+            elif path == '/user_mod':
+                user = catalog.users.get(form.getfirst('userid'))
+                if user:
+                    user[1] = int(form.getfirst('level'))
+                self._reply(200)
+            elif path == '/upload':
+                entry = simplejson.loads(form.getfirst('jdata'))
+                target = os.path.join(catalog.storage, '%s.xoj' % os.path.basename(entry[0]))
+                out = open(target, 'wb')
+                try:
+                    shutil.copyfileobj(form['file'].file, out)
+                finally:
+                    out.close()
+                catalog.files[entry[0]] = entry
+                catalog.changed()
+                self._reply(200)
+            elif path == '/remove':
+                fid = form.getfirst('fid')
+                if catalog.files.has_key(fid):
+                    del catalog.files[fid]
+                    catalog.changed()
+                self._reply(200)
+            else:
+                self._reply(404)
+        finally:
+            catalog.lock.release()
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, catalog):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandinHandler)
+        self.catalog = catalog
+
+def main():
+    port = 14623
+    storage = None
+    entries = 0
+
+    args = sys.argv[1:]
+    while args:
+        option = args.pop(0)
+        if option == '--port':
+            port = int(args.pop(0))
+        elif option == '--dir':
+            storage = args.pop(0)
+        elif option == '--entries':
+            entries = int(args.pop(0))
+        else:
+            print __doc__
+            sys.exit(1)
+
+    if storage is None:
+        storage = tempfile.mkdtemp()
+    elif not os.path.isdir(storage):
+        os.makedirs(storage)
+
+    catalog = Catalog(storage)
+    for i in xrange(entries):
+        file_id = '%040x' % i
+        catalog.files[file_id] = [file_id, 'Object %d' % i, 'Synthetic entry', '', 1024]
+
+    server = StandinServer(('', port), catalog)
+    print "Serving on port %d from %s" % (port, storage)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()